@@ -3,314 +3,462 @@ from __future__ import annotations
 import io
 import os
 import json
+import atexit
+import logging
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
-from datetime import datetime, date, timedelta
-from decimal import Decimal
+from datetime import datetime, date, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, Iterable, Iterator, List, Optional
 
-import openpyxl
-from openpyxl.utils import get_column_letter
+import orjson
 
 import psycopg
 from psycopg.rows import dict_row
+from psycopg.types.json import set_json_loads
+from psycopg_pool import ConnectionPool
 
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfgen import canvas
+# reportlab/openpyxl are imported inside the render functions: most requests never build a PDF/xlsx
+if TYPE_CHECKING:
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
 
+logger = logging.getLogger("ponude")
 
 # -----------------------------
 # Connection / bootstrap
 # -----------------------------
 
+_DB_URL = (os.getenv("DATABASE_URL") or os.getenv("POSTGRES_URL") or "").strip()
+
+
 def _db_url() -> str:
-    url = (os.getenv("DATABASE_URL") or os.getenv("POSTGRES_URL") or "").strip()
-    if not url:
+    if not _DB_URL:
         raise RuntimeError("DATABASE_URL is not set")
-    return url
+    return _DB_URL
+
+
+_POOL: ConnectionPool | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def _configure_conn(conn: psycopg.Connection) -> None:
+    # prepared_max is not a connect() option; keep up to 200 prepared statements per connection.
+    conn.prepared_max = 200
+    # json/jsonb results (export items, audit meta) are parsed by orjson instead of the stdlib.
+    set_json_loads(orjson.loads, conn)
+
+
+def _get_pool() -> ConnectionPool:
+    """Lazily open one process-wide pool (avoids a TCP/TLS handshake per call)."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                pool = ConnectionPool(
+                    _db_url(),
+                    min_size=2,
+                    max_size=10,
+                    # Fail a getconn() after 10s instead of the 30s default when the pool is exhausted.
+                    timeout=10,
+                    # Server-side prepare from a query text's second execution (see _configure_conn for the cache size).
+                    kwargs={"row_factory": dict_row, "prepare_threshold": 1},
+                    configure=_configure_conn,
+                    open=False,
+                )
+                pool.open()
+                atexit.register(pool.close)
+                _POOL = pool
+    return _POOL
+
+
+def open_pool() -> None:
+    """Open the pool up front (app startup) and wait for min_size connections."""
+    _get_pool().wait()
+
+
+def close_pool() -> None:
+    """Close the pool (app shutdown); a later get_conn() lazily opens a new one."""
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.close()
 
 
 @contextmanager
 def get_conn():
-    with psycopg.connect(_db_url(), row_factory=dict_row) as conn:
+    # Commits on clean exit / rolls back on error, like psycopg.connect() did.
+    with _get_pool().connection() as conn:
         yield conn
 
 
+# Bump whenever init_db() gains new DDL/backfills; startup skips init once schema_meta matches.
+SCHEMA_VERSION = 7
+_INITED = False
+_INIT_LOCK_KEY = 727324
+
+# Idempotent DDL + backfills run by init_db(), in order.
+_INIT_DDL = """
+-- Users
+create table if not exists users (
+  id bigserial primary key,
+  username text not null unique,
+  created_at timestamptz not null default now()
+);
+
+-- Schema meta (simple migration versioning)
+create table if not exists schema_meta (
+  id int primary key default 1,
+  version int not null default 0,
+  updated_at timestamptz not null default now()
+);
+insert into schema_meta(id, version) values (1, 0)
+on conflict (id) do nothing;
+
+-- Audit log
+create table if not exists audit_log (
+  id bigserial primary key,
+  user_id bigint,
+  username text,
+  action text not null,
+  offer_id bigint,
+  ip text,
+  meta jsonb,
+  created_at timestamptz not null default now()
+);
+
+-- Offers (legacy user_name retained; v2 uses user_id)
+create table if not exists offers (
+  id bigserial primary key,
+  user_id bigint,
+  user_name text not null,
+  client_name text,
+  client_email text,
+  client_address text,
+  client_oib text,
+  created_at timestamptz not null default now(),
+  sent_at timestamptz,
+  last_email_to text,
+  last_email_at timestamptz,
+  last_email_error text,
+  email_attempts int not null default 0,
+
+
+  -- numbering
+  offer_year int,
+  offer_seq int,
+  offer_no text,
+
+  -- workflow
+  status text not null default 'DRAFT',
+  accepted_at timestamptz,
+
+  -- archive (soft delete)
+  archived boolean not null default false,
+  archived_at timestamptz,
+
+  -- meta for PDF
+  terms_delivery text,
+  terms_payment text,
+  note text,
+  place text,
+  signed_by text,
+  vat_rate double precision not null default 0
+);
+
+-- Items
+create table if not exists offer_items (
+  id bigserial primary key,
+  offer_id bigint not null references offers(id) on delete cascade,
+  name text not null,
+  qty double precision not null default 1,
+  price double precision not null default 0,
+  line_total double precision not null default 0,
+  created_at timestamptz not null default now()
+);
+
+-- Company settings (legacy user_name PK retained; add user_id + logo bytes)
+create table if not exists company_settings (
+  user_name text primary key,
+  company_name text,
+  company_address text,
+  company_oib text,
+  company_iban text,
+  company_email text,
+  company_phone text,
+  logo_path text,
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now()
+);
+
+-- Clients
+create table if not exists clients (
+  id bigserial primary key,
+  user_id bigint,
+  user_name text not null,
+  name text not null,
+  email text,
+  address text,
+  oib text,
+  note text,
+  created_at timestamptz not null default now()
+);
+
+-- --- Migrations (ADD COLUMN IF NOT EXISTS) ---
+-- One ALTER per table: parsed and locked once instead of once per column.
+alter table offers
+  -- portal/tracking
+  add column if not exists public_token text,
+  add column if not exists view_count int not null default 0,
+  add column if not exists first_view_at timestamptz,
+  add column if not exists last_view_at timestamptz,
+  add column if not exists last_view_ip text,
+  add column if not exists click_count int not null default 0,
+  add column if not exists last_click_at timestamptz,
+  add column if not exists last_click_ip text,
+  add column if not exists accepted_via text,
+  add column if not exists accepted_via_at timestamptz,
+  add column if not exists valid_until date,
+  -- user_id + archive fields (for older DBs)
+  add column if not exists user_id bigint,
+  add column if not exists archived boolean not null default false,
+  add column if not exists archived_at timestamptz,
+  -- status workflow extras
+  add column if not exists client_email text,
+  add column if not exists sent_at timestamptz,
+  add column if not exists last_email_to text,
+  add column if not exists last_email_at timestamptz,
+  add column if not exists last_email_error text,
+  add column if not exists email_attempts int not null default 0,
+  -- invoice fields
+  add column if not exists is_invoice boolean not null default false,
+  add column if not exists invoice_year int,
+  add column if not exists invoice_seq int,
+  add column if not exists invoice_no text,
+  add column if not exists invoice_date timestamptz,
+  add column if not exists paid boolean not null default false,
+  add column if not exists paid_at timestamptz,
+  -- client extra fields
+  add column if not exists client_address text,
+  add column if not exists client_oib text,
+  -- stored items total (kept in sync by statement-level triggers on offer_items)
+  add column if not exists total double precision not null default 0;
+
+alter table company_settings
+  -- templates
+  add column if not exists email_subject_tpl text,
+  add column if not exists email_html_tpl text,
+  add column if not exists email_text_tpl text,
+  add column if not exists pdf_footer_tpl text,
+  -- user_id + logo bytes
+  add column if not exists user_id bigint,
+  add column if not exists logo_bytes bytea,
+  add column if not exists logo_mime text,
+  add column if not exists logo_filename text;
+
+alter table clients
+  add column if not exists user_id bigint,
+  add column if not exists email text,
+  add column if not exists address text,
+  add column if not exists oib text,
+  add column if not exists note text;
+
+-- Offers: items total trigger. Applies per-offer deltas: o.total is re-read after the row lock,
+-- so concurrent item writes on one offer add up instead of overwriting each other's sum.
+create or replace function offer_items_total_trg() returns trigger
+language plpgsql as $$
+begin
+    if tg_op = 'INSERT' then
+        update offers o
+           set total = o.total + d.delta
+          from (select offer_id, sum(line_total) as delta from new_rows group by offer_id) d
+         where o.id = d.offer_id;
+    elsif tg_op = 'DELETE' then
+        update offers o
+           set total = o.total - d.delta
+          from (select offer_id, sum(line_total) as delta from old_rows group by offer_id) d
+         where o.id = d.offer_id;
+    else
+        update offers o
+           set total = o.total + d.delta
+          from (
+            select offer_id, sum(line_total) as delta
+            from (select offer_id, line_total from new_rows
+                  union all
+                  select offer_id, -line_total from old_rows) x
+            group by offer_id
+          ) d
+         where o.id = d.offer_id and d.delta <> 0;
+    end if;
+    return null;
+end
+$$;
+drop trigger if exists offer_items_total_ins on offer_items;
+drop trigger if exists offer_items_total_upd on offer_items;
+drop trigger if exists offer_items_total_del on offer_items;
+
+create trigger offer_items_total_ins after insert on offer_items
+referencing new table as new_rows
+for each statement execute function offer_items_total_trg();
+
+create trigger offer_items_total_upd after update on offer_items
+referencing old table as old_rows new table as new_rows
+for each statement execute function offer_items_total_trg();
+
+create trigger offer_items_total_del after delete on offer_items
+referencing old table as old_rows
+for each statement execute function offer_items_total_trg();
+
+-- Offers: email send outcome (called by record_email_result()); success marks SENT unless ACCEPTED
+create or replace function record_email_result(p_offer_id bigint, p_user_id bigint, p_to text, p_ok boolean, p_err text)
+returns void
+language plpgsql as $$
+begin
+    update offers o
+       set email_attempts = o.email_attempts + 1,
+           last_email_to = p_to,
+           last_email_at = now(),
+           last_email_error = p_err,
+           status = case when p_ok and o.status <> 'ACCEPTED' then 'SENT' else o.status end,
+           sent_at = case when p_ok and o.status <> 'ACCEPTED' then coalesce(o.sent_at, now()) else o.sent_at end
+     where o.id = p_offer_id and o.user_id = p_user_id and o.archived = false;
+end
+$$;
+
+-- Backfill stored totals for rows written before the trigger existed
+update offers o
+   set total = s.total
+  from (select offer_id, sum(line_total) as total from offer_items group by offer_id) s
+ where s.offer_id = o.id and o.total is distinct from s.total;
+
+-- Indexes (keep legacy indexes too)
+create unique index if not exists offers_public_token_uix on offers(public_token) where public_token is not null;
+create index if not exists idx_offers_user_name on offers(user_name);
+create index if not exists idx_offers_user_id on offers(user_id);
+
+-- Covering index: list_items / total triggers read items by offer in id order without heap fetches
+create index if not exists idx_offer_items_offer_id_id on offer_items(offer_id, id) include (name, qty, price, line_total);
+drop index if exists idx_offer_items_offer_id;
+create unique index if not exists idx_clients_user_name_name on clients(user_name, name);
+create unique index if not exists idx_users_username on users(username);
+create unique index if not exists idx_company_settings_user_id on company_settings(user_id) where user_id is not null;
+create index if not exists idx_clients_user_id on clients(user_id);
+create index if not exists idx_offers_user_year_seq on offers(user_name, offer_year, offer_seq);
+create index if not exists idx_offers_userid_year_seq on offers(user_id, offer_year, offer_seq);
+create index if not exists idx_offers_invoice_user_year_seq on offers(user_id, invoice_year, invoice_seq);
+
+-- list_offers: default (active) listing and status-filtered listing, both matching the sort order
+create index if not exists idx_offers_active_created on offers(created_at desc, id desc) where archived = false;
+create index if not exists idx_offers_status_created on offers(status, created_at desc, id desc) where archived = false;
+
+-- create_offer: max(offer_seq) per owner/year among active offers
+create index if not exists idx_offers_owner_year_seq_active on offers(user_id, offer_year, offer_seq desc) where archived = false;
+-- Guarded offer writes (id + owner + status/archived) answered from the index alone
+create index if not exists idx_offers_id_owner_cover on offers(id) include (user_id, user_name, status, archived);
+-- Existing databases only: owner predicates match on user_id, the lower(user_name) index is unused
+drop index if exists idx_offers_username_lower;
+
+-- Backfill users from legacy tables (if any)
+insert into users(username)
+select distinct lower(user_name) from (
+  select user_name from offers
+  union all
+  select user_name from company_settings
+  union all
+  select user_name from clients
+) s
+where user_name is not null and btrim(user_name) <> ''
+on conflict do nothing;
+
+-- Backfill user_id columns using users table
+update offers o
+set user_id = u.id
+from users u
+where o.user_id is null
+  and lower(o.user_name) = u.username;
+
+update clients c
+set user_id = u.id
+from users u
+where c.user_id is null
+  and lower(c.user_name) = u.username;
+
+update company_settings s
+set user_id = u.id
+from users u
+where s.user_id is null
+  and lower(s.user_name) = u.username;
+
+-- Backfill / ensure defaults
+update offers set vat_rate=0 where vat_rate is null;
+update offers set status='DRAFT' where status is null;
+"""
+
+
+def _schema_version(conn) -> int:
+    row = conn.execute("select to_regclass('schema_meta') is not null as present").fetchone()
+    if not row or not row["present"]:
+        return 0
+    row = conn.execute("select version from schema_meta where id=1").fetchone()
+    return int(row["version"]) if row else 0
+
+
 def init_db() -> None:
     """
     Idempotent schema init for Postgres.
-    Safe to run on every startup.
+    Safe to run on every startup; a no-op once schema_meta.version == SCHEMA_VERSION.
     """
+    global _INITED
+    if _INITED:
+        return
     with get_conn() as conn:
-        # Users
-        conn.execute(
-            """
-            create table if not exists users (
-              id bigserial primary key,
-              username text not null unique,
-              created_at timestamptz not null default now()
-            );
-            """
-        )
-
-        # Schema meta (simple migration versioning)
-        conn.execute(
-            """
-            create table if not exists schema_meta (
-              id int primary key default 1,
-              version int not null default 0,
-              updated_at timestamptz not null default now()
-            );
-            insert into schema_meta(id, version) values (1, 0)
-            on conflict (id) do nothing;
-            """
-        )
-
-        # Audit log
-        conn.execute(
-            """
-            create table if not exists audit_log (
-              id bigserial primary key,
-              user_id bigint,
-              username text,
-              action text not null,
-              offer_id bigint,
-              ip text,
-              meta jsonb,
-              created_at timestamptz not null default now()
-            );
-            """
-        )
-
-        # Offers (legacy user_name retained; v2 uses user_id)
-        conn.execute(
-            """
-            create table if not exists offers (
-              id bigserial primary key,
-              user_id bigint,
-              user_name text not null,
-              client_name text,
-              client_email text,
-              client_address text,
-              client_oib text,
-              created_at timestamptz not null default now(),
-              sent_at timestamptz,
-              last_email_to text,
-              last_email_at timestamptz,
-              last_email_error text,
-              email_attempts int not null default 0,
-
-
-              -- numbering
-              offer_year int,
-              offer_seq int,
-              offer_no text,
-
-              -- workflow
-              status text not null default 'DRAFT',
-              accepted_at timestamptz,
-
-              -- archive (soft delete)
-              archived boolean not null default false,
-              archived_at timestamptz,
-
-              -- meta for PDF
-              terms_delivery text,
-              terms_payment text,
-              note text,
-              place text,
-              signed_by text,
-              vat_rate double precision not null default 0
-            );
-            """
-        )
-
-        
-        # Offers - portal/tracking fields (idempotent)
-        conn.execute("alter table offers add column if not exists public_token text;")
-        conn.execute("alter table offers add column if not exists view_count int not null default 0;")
-        conn.execute("alter table offers add column if not exists first_view_at timestamptz;")
-        conn.execute("alter table offers add column if not exists last_view_at timestamptz;")
-        conn.execute("alter table offers add column if not exists last_view_ip text;")
-        conn.execute("alter table offers add column if not exists click_count int not null default 0;")
-        conn.execute("alter table offers add column if not exists last_click_at timestamptz;")
-        conn.execute("alter table offers add column if not exists last_click_ip text;")
-        conn.execute("alter table offers add column if not exists accepted_via text;")
-        conn.execute("alter table offers add column if not exists accepted_via_at timestamptz;")
-        conn.execute("create unique index if not exists offers_public_token_uix on offers(public_token) where public_token is not null;")
-        conn.execute("alter table offers add column if not exists valid_until date;")
-# Items
-        conn.execute(
-            """
-            create table if not exists offer_items (
-              id bigserial primary key,
-              offer_id bigint not null references offers(id) on delete cascade,
-              name text not null,
-              qty double precision not null default 1,
-              price double precision not null default 0,
-              line_total double precision not null default 0,
-              created_at timestamptz not null default now()
-            );
-            """
-        )
-
-        # Company settings (legacy user_name PK retained; add user_id + logo bytes)
-        conn.execute(
-            """
-            create table if not exists company_settings (
-              user_name text primary key,
-              company_name text,
-              company_address text,
-              company_oib text,
-              company_iban text,
-              company_email text,
-              company_phone text,
-              logo_path text,
-              created_at timestamptz not null default now(),
-              updated_at timestamptz not null default now()
-            );
-            """
-        )
-
-        # Clients
-        conn.execute(
-            """
-            create table if not exists clients (
-              id bigserial primary key,
-              user_id bigint,
-              user_name text not null,
-              name text not null,
-              email text,
-              address text,
-              oib text,
-              note text,
-              created_at timestamptz not null default now()
-            );
-            """
-        )
+        if _schema_version(conn) >= SCHEMA_VERSION:
+            _INITED = True
+            return
 
-        # --- Migrations (ADD COLUMN IF NOT EXISTS) ---
-        # Offers: user_id + archive fields (for older DBs)
-        conn.execute("alter table offers add column if not exists user_id bigint;")
-        conn.execute("alter table offers add column if not exists archived boolean not null default false;")
-        conn.execute("alter table offers add column if not exists archived_at timestamptz;")
-
-        # Offers: status workflow extras
-        conn.execute("alter table offers add column if not exists client_email text;")
-        conn.execute("alter table offers add column if not exists sent_at timestamptz;")
-        conn.execute("alter table offers add column if not exists last_email_to text;")
-        conn.execute("alter table offers add column if not exists last_email_at timestamptz;")
-        conn.execute("alter table offers add column if not exists last_email_error text;")
-        conn.execute("alter table offers add column if not exists email_attempts int not null default 0;")
-
-        # Offers: invoice fields
-        conn.execute("alter table offers add column if not exists is_invoice boolean not null default false;")
-        conn.execute("alter table offers add column if not exists invoice_year int;")
-        conn.execute("alter table offers add column if not exists invoice_seq int;")
-        conn.execute("alter table offers add column if not exists invoice_no text;")
-        conn.execute("alter table offers add column if not exists invoice_date timestamptz;")
-        conn.execute("alter table offers add column if not exists paid boolean not null default false;")
-        conn.execute("alter table offers add column if not exists paid_at timestamptz;")
-
-        # Company settings: templates
-        conn.execute("alter table company_settings add column if not exists email_subject_tpl text;")
-        conn.execute("alter table company_settings add column if not exists email_html_tpl text;")
-        conn.execute("alter table company_settings add column if not exists email_text_tpl text;")
-        conn.execute("alter table company_settings add column if not exists pdf_footer_tpl text;")
-
-
-        # Settings: user_id + logo bytes
-        conn.execute("alter table company_settings add column if not exists user_id bigint;")
-        conn.execute("alter table company_settings add column if not exists logo_bytes bytea;")
-        conn.execute("alter table company_settings add column if not exists logo_mime text;")
-        conn.execute("alter table company_settings add column if not exists logo_filename text;")
-
-        # Clients: user_id
-        conn.execute("alter table clients add column if not exists user_id bigint;")
-
-        # Clients: extra fields
-        conn.execute("alter table clients add column if not exists email text;")
-        conn.execute("alter table clients add column if not exists address text;")
-        conn.execute("alter table clients add column if not exists oib text;")
-        conn.execute("alter table clients add column if not exists note text;")
-
-        # Offers: client extra fields
-        conn.execute("alter table offers add column if not exists client_address text;")
-        conn.execute("alter table offers add column if not exists client_oib text;")
-
-
-        # Indexes (keep legacy indexes too)
-        conn.execute("create index if not exists idx_offers_user_name on offers(user_name);")
-        conn.execute("create index if not exists idx_offers_user_id on offers(user_id);")
-        conn.execute("create index if not exists idx_offer_items_offer_id on offer_items(offer_id);")
-        conn.execute("create unique index if not exists idx_clients_user_name_name on clients(user_name, name);")
-        conn.execute("create unique index if not exists idx_users_username on users(username);")
-        conn.execute("create unique index if not exists idx_company_settings_user_id on company_settings(user_id) where user_id is not null;")
-        conn.execute("create index if not exists idx_clients_user_id on clients(user_id);")
-        conn.execute("create index if not exists idx_offers_user_year_seq on offers(user_name, offer_year, offer_seq);")
-        conn.execute("create index if not exists idx_offers_userid_year_seq on offers(user_id, offer_year, offer_seq);")
-        conn.execute("create index if not exists idx_offers_invoice_user_year_seq on offers(user_id, invoice_year, invoice_seq);")
-
-        # Backfill users from legacy tables (if any)
-        conn.execute(
-            """
-            insert into users(username)
-            select distinct lower(user_name) from (
-              select user_name from offers
-              union all
-              select user_name from company_settings
-              union all
-              select user_name from clients
-            ) s
-            where user_name is not null and btrim(user_name) <> ''
-            on conflict do nothing;
-            """
-        )
+    # Migrate on a dedicated connection that never prepares: nothing planned here outlives the DDL.
+    with psycopg.connect(_db_url(), row_factory=dict_row, prepare_threshold=None) as conn:
+        # Serialise concurrent workers; the lock is released when this transaction commits.
+        conn.execute("select pg_advisory_xact_lock(%s)", (_INIT_LOCK_KEY,))
+        if _schema_version(conn) >= SCHEMA_VERSION:
+            _INITED = True
+            return
 
-        # Backfill user_id columns using users table
-        conn.execute(
-            """
-            update offers o
-            set user_id = u.id
-            from users u
-            where o.user_id is null
-              and lower(o.user_name) = u.username;
-            """
-        )
-        conn.execute(
-            """
-            update clients c
-            set user_id = u.id
-            from users u
-            where c.user_id is null
-              and lower(c.user_name) = u.username;
-            """
-        )
-        conn.execute(
-            """
-            update company_settings s
-            set user_id = u.id
-            from users u
-            where s.user_id is null
-              and lower(s.user_name) = u.username;
-            """
-        )
+        # Whole schema in one simple-query round-trip (multi-statement, no params, never prepared)
+        conn.execute(_INIT_DDL, prepare=False)
 
-        # Backfill / ensure defaults
-        conn.execute("update offers set vat_rate=0 where vat_rate is null;")
-        conn.execute("update offers set status='DRAFT' where status is null;")
-        try:
-            conn.execute("alter table offers alter column status set default 'DRAFT';")
-        except Exception:
-            pass
+        # Savepoint: a failed ALTER must not abort the surrounding init transaction
         try:
-            conn.execute("alter table offers alter column status set not null;")
+            with conn.transaction():
+                conn.execute("alter table offers alter column status set default 'DRAFT', alter column status set not null;", prepare=False)
         except Exception:
             pass
 
+        # Owner lookups compare user_id only. The backfill above fills it wherever user_name is set;
+        # rows it cannot fill (blank user_name) belong to nobody and block the constraint.
+        for table in ("offers", "clients", "company_settings"):
+            try:
+                with conn.transaction():
+                    conn.execute(f"alter table {table} alter column user_id set not null;", prepare=False)
+            except Exception as e:
+                nulls = conn.execute(f"select count(*) as n from {table} where user_id is null", prepare=False).fetchone()["n"]
+                logger.warning("[init_db] %s.user_id left nullable, %d rows without an owner are unreachable: %s", table, nulls, e)
+
+        conn.execute("update schema_meta set version=%s, updated_at=now() where id=1", (SCHEMA_VERSION,))
+
+    # Pooled connections may hold plans prepared against the old schema
+    # ("cached plan must not change result type"): replace them.
+    if _POOL is not None:
+        close_pool()
+        open_pool()
+    _INITED = True
+
 
 # -----------------------------
 # Users
@@ -320,14 +468,23 @@ def ensure_user(username: str) -> int:
     username = (username or "").strip().lower()
     if not username:
         raise ValueError("username required")
+    return _ensure_user_id(username)
+
+
+@lru_cache(maxsize=4096)
+def _ensure_user_id(username: str) -> int:
+    """username -> users.id, resolved once per process (users are never deleted or renamed)."""
     with get_conn() as conn:
-        row = conn.execute("select id from users where username=%s", (username,)).fetchone()
+        row = conn.execute("select id from users where username=%s", (username,), prepare=True).fetchone()
         if row:
             return int(row["id"])
+        # do nothing: no dead tuple/WAL for an existing name; on a lost race, re-read the winner's row
         row2 = conn.execute(
-            "insert into users(username) values (%s) on conflict (username) do update set username=excluded.username returning id",
+            "insert into users(username) values (%s) on conflict (username) do nothing returning id",
             (username,),
         ).fetchone()
+        if row2 is None:
+            row2 = conn.execute("select id from users where username=%s", (username,), prepare=True).fetchone()
         return int(row2["id"])
 
 
@@ -335,74 +492,90 @@ def ensure_user(username: str) -> int:
 # Offers
 # -----------------------------
 
+def _strip_or_none(s: str | None) -> str | None:
+    # Form/backup text: blank or whitespace-only means "not set".
+    if not s:
+        return None
+    return s.strip() or None
+
+
 def _offer_owner_clause() -> str:
-    # Robust for legacy rows where user_id might be null.
-    return "(o.user_id = %s or (o.user_id is null and lower(o.user_name) = %s))"
+    # user_id is NOT NULL (legacy rows are backfilled from user_name in init_db).
+    return "o.user_id = %s"
 
 
 
 def next_offer_no(user_id: int, username: str, year: int | None = None) -> str:
-    """Generate next offer number in format YYYY-0001 (per user)."""
-    import datetime as _dt
-    y = year or _dt.datetime.now().year
-    prefix = f"{y}-"
+    """Next offer number in format YYYY-0001 (per user); same numbering rule as create_offer()."""
+    y = year or datetime.now().year
     with get_conn() as conn:
-        # Prefer already padded format for ordering
         row = conn.execute(
-            "select offer_no from offers where (user_id=%s or user_name=%s) and (%s is null or client_id=%s) and offer_no like %s order by offer_no desc limit 1",
-            (user_id, username, prefix + "%"),
-        ).fetchone()
-    if row and row.get("offer_no") and str(row["offer_no"]).startswith(prefix):
-        tail = str(row["offer_no"])[len(prefix):]
-        try:
-            n = int(tail)
-        except Exception:
-            n = 0
-        n += 1
-    else:
-        n = 1
-    return f"{prefix}{n:04d}"
-
-def create_offer(user_id: int, username: str, client_name: str | None = None) -> int:
-    year = datetime.now().year
-    username_l = (username or "").strip().lower()
-    with get_conn() as conn:
-        row_seq = conn.execute(
             """
             select coalesce(max(offer_seq), 0) as max_seq
             from offers
-            where (user_id=%s or (user_id is null and lower(user_name)=%s))
+            where user_id=%s
               and offer_year=%s
               and archived=false
             """,
-            (user_id, username_l, year),
+            (user_id, y),
+            prepare=True,
         ).fetchone()
-        next_seq = int((row_seq or {}).get("max_seq") or 0) + 1
-        offer_no = f"{year}-{next_seq:04d}"
+    return f"{y}-{int(row['max_seq']) + 1:04d}"
 
+
+def create_offer(user_id: int, username: str, client_name: str | None = None) -> int:
+    with get_conn() as conn:
+        return _create_offer(conn, user_id, username, client_name)
+
+
+def _create_offer(conn, user_id: int, username: str, client_name: str | None = None) -> int:
+    """create_offer() on the caller's connection, so it commits with the caller's transaction."""
+    year = datetime.now().year
+    username_l = (username or "").strip().lower()
+    with conn.pipeline():
+        # Serialise numbering per owner/year until commit. It must be its own statement: the insert's
+        # snapshot is taken when it starts, i.e. after the lock is held. Pipelined, so still one round-trip.
+        conn.execute(
+            "select pg_advisory_xact_lock(hashtext('offer_seq:' || %s::text || ':' || %s::text))",
+            (user_id, year),
+        )
+        # Next seq + insert in one statement; offer_no = YYYY-0001
         row = conn.execute(
             """
+            with nxt as (
+              select coalesce(max(offer_seq), 0) + 1 as seq
+              from offers
+              where user_id=%s
+                and offer_year=%s
+                and archived=false
+            )
             insert into offers(user_id, user_name, client_name, offer_year, offer_seq, offer_no, status, vat_rate, valid_until, archived)
-            values (%s, %s, %s, %s, %s, %s, %s, %s, %s, false)
+            select %s, %s, %s, %s, nxt.seq, %s || '-' || lpad(nxt.seq::text, greatest(4, length(nxt.seq::text)), '0'),
+                   'DRAFT', 0, %s, false
+            from nxt
             returning id
             """,
-            (user_id, username_l, client_name, year, next_seq, offer_no, "DRAFT", 0, (date.today() + timedelta(days=14))),
+            (user_id, year,
+             user_id, username_l, client_name, year, str(year), (date.today() + timedelta(days=14))),
         ).fetchone()
         return int(row["id"])
 
 
+_GET_OFFER_SQL = f"""
+select o.id, o.user_id, o.user_name, o.client_name, o.created_at, o.offer_no, o.offer_year, o.offer_seq,
+       o.status, o.accepted_at, o.sent_at, o.archived, o.archived_at, o.client_email, o.client_address, o.client_oib,
+       o.terms_delivery, o.terms_payment, o.note, o.place, o.signed_by, o.vat_rate, o.valid_until
+from offers o
+where o.id=%s and {_offer_owner_clause()}
+"""
+
+
 def get_offer(user_id: int, username: str, offer_id: int):
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
         return conn.execute(
-            f"""
-            select o.id, o.user_id, o.user_name, o.client_name, o.created_at, o.offer_no, o.offer_year, o.offer_seq,
-                   o.status, o.accepted_at, o.sent_at, o.archived, o.archived_at, o.client_email, o.client_address, o.client_oib,
-                   o.terms_delivery, o.terms_payment, o.note, o.place, o.signed_by, o.vat_rate
-            from offers o
-            where o.id=%s and {_offer_owner_clause()}
-            """,
-            (offer_id, user_id, username_l),
+            _GET_OFFER_SQL,
+            (offer_id, user_id),
+            prepare=True,
         ).fetchone()
 
 
@@ -415,35 +588,87 @@ def _ensure_editable(offer_row: dict) -> None:
         raise ValueError("Ova ponuda je zaključana (ACCEPTED).")
 
 
-
-def update_offer_client_email(user_id: int, username: str, offer_id: int, client_email: str | None) -> None:
-    username_l = (username or "").strip().lower()
-    email = (client_email or "").strip() or None
-    with get_conn() as conn:
-        offer = conn.execute(
-            f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
-        ).fetchone()
-        if not offer:
-            return
+def _offer_editable_clause() -> str:
+    # SQL twin of _ensure_editable(); status/archived are NOT NULL.
+    return "o.archived = false and o.status <> 'ACCEPTED'"
+
+
+# Guarded writes: a single statement that only matches an owned, editable offer.
+# Built once at import, so every call sends identical text (one prepared statement).
+_OFFER_WRITE_GUARD = f"o.id=%s and {_offer_owner_clause()} and {_offer_editable_clause()}"
+_OFFER_LOCK_STATE_SQL = f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}"
+# Columns the update_offer_* / save_offer_meta wrappers may set through _update_offer_fields().
+_OFFER_UPDATABLE_FIELDS = frozenset({
+    "client_name",
+    "client_email",
+    "client_address",
+    "client_oib",
+    "terms_delivery",
+    "terms_payment",
+    "note",
+    "place",
+    "signed_by",
+    "vat_rate",
+    "valid_until",
+})
+_SAVE_OFFER_CLIENT_SQL = f"""
+with upd as (
+  update offers o
+  set client_name=%s, client_email=%s, client_address=%s, client_oib=%s
+  where {_OFFER_WRITE_GUARD}
+  returning o.id
+), ins as (
+  insert into clients(user_id, user_name, name, email, address, oib)
+  select %s, %s, %s, %s, %s, %s from upd where %s::text is not null
+  on conflict (user_name, name)
+  do update set
+    user_id = excluded.user_id,
+    email = coalesce(excluded.email, clients.email),
+    address = coalesce(excluded.address, clients.address),
+    oib = coalesce(excluded.oib, clients.oib)
+)
+select count(*) as n from upd
+"""
+
+
+def _raise_if_locked(conn, offer_id: int, user_id: int) -> None:
+    """A fused owner+editable write matched nothing: raise the usual error if the offer is locked.
+
+    Missing / foreign offers stay a silent no-op, as before.
+    """
+    offer = conn.execute(
+        _OFFER_LOCK_STATE_SQL,
+        (offer_id, user_id),
+        prepare=True,
+    ).fetchone()
+    if offer:
         _ensure_editable(dict(offer))
-        conn.execute("update offers set client_email=%s where id=%s", (email, offer_id))
+
+
+@lru_cache(maxsize=None)
+def _update_offer_fields_sql(cols: tuple[str, ...]) -> str:
+    # One text per column set, so each wrapper keeps hitting the same prepared statement.
+    sets = ", ".join(f"{col}=%s" for col in cols)
+    return f"update offers o set {sets} where {_OFFER_WRITE_GUARD}"
+
+
+def _update_offer_fields(conn, offer_id: int, user_id: int, **fields: Any) -> None:
+    """Guarded single-statement update of whitelisted offer columns."""
+    unknown = fields.keys() - _OFFER_UPDATABLE_FIELDS
+    if unknown:
+        raise ValueError(f"Nepoznata polja ponude: {', '.join(sorted(unknown))}")
+    cur = conn.execute(
+        _update_offer_fields_sql(tuple(fields)),
+        (*fields.values(), offer_id, user_id),
+        prepare=True,
+    )
+    if cur.rowcount == 0:
+        _raise_if_locked(conn, offer_id, user_id)
 
 
 def update_offer_client_name(user_id: int, username: str, offer_id: int, client_name: str | None) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        offer = conn.execute(
-            f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
-        ).fetchone()
-        if not offer:
-            return
-        _ensure_editable(dict(offer))
-        conn.execute(
-            "update offers set client_name=%s where id=%s",
-            (client_name, offer_id),
-        )
+        _update_offer_fields(conn, offer_id, user_id, client_name=client_name)
 
 
 def update_offer_client_details(
@@ -455,39 +680,20 @@ def update_offer_client_details(
     client_address: str | None,
     client_oib: str | None,
 ) -> None:
-    username_l = (username or "").strip().lower()
-    nm = (client_name or "").strip() or None
-    em = (client_email or "").strip() or None
-    addr = (client_address or "").strip() or None
-    oib = (client_oib or "").strip() or None
+    nm = _strip_or_none(client_name)
+    em = _strip_or_none(client_email)
+    addr = _strip_or_none(client_address)
+    oib = _strip_or_none(client_oib)
     with get_conn() as conn:
-        offer = conn.execute(
-            f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
-        ).fetchone()
-        if not offer:
-            return
-        _ensure_editable(dict(offer))
-        conn.execute(
-            "update offers set client_name=%s, client_email=%s, client_address=%s, client_oib=%s where id=%s",
-            (nm, em, addr, oib, offer_id),
+        _update_offer_fields(
+            conn, offer_id, user_id,
+            client_name=nm, client_email=em, client_address=addr, client_oib=oib,
         )
 
+
 def update_offer_client_email(user_id: int, username: str, offer_id: int, client_email: str | None) -> None:
-    username_l = (username or "").strip().lower()
-    client_email = (client_email or "").strip() or None
     with get_conn() as conn:
-        offer = conn.execute(
-            f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
-        ).fetchone()
-        if not offer:
-            return
-        _ensure_editable(dict(offer))
-        conn.execute(
-            "update offers set client_email=%s where id=%s",
-            (client_email, offer_id),
-        )
+        _update_offer_fields(conn, offer_id, user_id, client_email=_strip_or_none(client_email))
 
 
 def update_offer_meta(
@@ -502,134 +708,149 @@ def update_offer_meta(
     vat_rate: float | None,
     valid_until: str | None,
 ) -> None:
+    with get_conn() as conn:
+        _update_offer_fields(
+            conn, offer_id, user_id,
+            terms_delivery=terms_delivery,
+            terms_payment=terms_payment,
+            note=note,
+            place=place,
+            signed_by=signed_by,
+            vat_rate=float(vat_rate or 0),
+            valid_until=valid_until,
+        )
+
+
+def save_offer_meta(
+    user_id: int,
+    username: str,
+    offer_id: int,
+    client_email: str | None,
+    terms_delivery: str | None,
+    terms_payment: str | None,
+    note: str | None,
+    place: str | None,
+    signed_by: str | None,
+    vat_rate: float | None,
+    valid_until: str | None,
+) -> None:
+    """Save the offer details form (client email + PDF meta) in one statement."""
+    with get_conn() as conn:
+        _update_offer_fields(
+            conn, offer_id, user_id,
+            client_email=_strip_or_none(client_email),
+            terms_delivery=terms_delivery,
+            terms_payment=terms_payment,
+            note=note,
+            place=place,
+            signed_by=signed_by,
+            vat_rate=float(vat_rate or 0),
+            valid_until=_strip_or_none(valid_until),
+        )
+
+
+def save_offer_client(
+    user_id: int,
+    username: str,
+    offer_id: int,
+    client_name: str | None,
+    client_email: str | None,
+    client_address: str | None,
+    client_oib: str | None,
+) -> None:
+    """Set the offer's client details and upsert the client list entry in one statement."""
     username_l = (username or "").strip().lower()
+    nm = _strip_or_none(client_name)
+    em = _strip_or_none(client_email)
+    addr = _strip_or_none(client_address)
+    oib = _strip_or_none(client_oib)
     with get_conn() as conn:
-        offer = conn.execute(
-            f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
+        # The clients upsert only fires when the guarded offer update matched (reads from upd).
+        row = conn.execute(
+            _SAVE_OFFER_CLIENT_SQL,
+            (nm, em, addr, oib, offer_id, user_id, user_id, username_l, nm, em, addr, oib, nm),
+            prepare=True,
         ).fetchone()
-        if not offer:
-            return
-        _ensure_editable(dict(offer))
-        conn.execute(
-            """
-            update offers
-            set terms_delivery=%s,
-                terms_payment=%s,
-                note=%s,
-                place=%s,
-                signed_by=%s,
-                vat_rate=%s,
-                valid_until=%s
-            where id=%s
-            """,
-            (terms_delivery, terms_payment, note, place, signed_by, float(vat_rate or 0), offer_id),
-        )
+        if not row["n"]:
+            _raise_if_locked(conn, offer_id, user_id)
+
+
+# Status transitions (owned, non-archived offers).
+_ACCEPT_OFFER_SQL = f"""
+update offers o
+set status='ACCEPTED', accepted_at=now()
+where o.id=%s and {_offer_owner_clause()} and o.archived=false
+"""
+_UNLOCK_OFFER_SQL = f"""
+update offers o
+set status='DRAFT', accepted_at=null
+where o.id=%s and {_offer_owner_clause()} and o.archived=false
+"""
+_MARK_OFFER_SENT_SQL = f"""
+update offers o
+set status='SENT', sent_at=now()
+where o.id=%s and {_offer_owner_clause()} and o.archived=false and o.status <> 'ACCEPTED'
+"""
 
 
 def accept_offer(user_id: int, username: str, offer_id: int) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        conn.execute(
-            f"""
-            update offers o
-            set status='ACCEPTED', accepted_at=now()
-            where o.id=%s and {_offer_owner_clause()} and o.archived=false
-            """,
-            (offer_id, user_id, username_l),
-        )
+        conn.execute(_ACCEPT_OFFER_SQL, (offer_id, user_id), prepare=True)
 
 
 def unlock_offer(user_id: int, username: str, offer_id: int) -> None:
     """
     Safety valve: allow reverting ACCEPTED -> DRAFT (keeps numbering).
     """
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        conn.execute(
-            f"""
-            update offers o
-            set status='DRAFT', accepted_at=null
-            where o.id=%s and {_offer_owner_clause()} and o.archived=false
-            """,
-            (offer_id, user_id, username_l),
-        )
+        conn.execute(_UNLOCK_OFFER_SQL, (offer_id, user_id), prepare=True)
 
 
 
 def mark_offer_sent(user_id: int, username: str, offer_id: int) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        conn.execute(
-            f"""
-            update offers o
-            set status='SENT', sent_at=now()
-            where o.id=%s and {_offer_owner_clause()} and o.archived=false and o.status <> 'ACCEPTED'
-            """,
-            (offer_id, user_id, username_l),
-        )
+        conn.execute(_MARK_OFFER_SENT_SQL, (offer_id, user_id), prepare=True)
 
 
 def record_email_result(user_id: int, username: str, offer_id: int, to_email: str, ok: bool, error: str | None = None) -> None:
     """Persist email send attempt outcome for audit/resend."""
-    username_l = (username or "").strip().lower()
     to_email = (to_email or "").strip()
     err_txt = (error or "").strip() if not ok else None
     with get_conn() as conn:
-        # bump attempts and store last result
+        # Server-side function (see _INIT_DDL): bumps attempts, stores the result, marks SENT on success
         conn.execute(
-            f"""
-            update offers o
-            set
-              email_attempts = coalesce(o.email_attempts,0) + 1,
-              last_email_to = %s,
-              last_email_at = now(),
-              last_email_error = %s,
-              -- Mark as SENT on success (do not override ACCEPTED)
-              status = case
-                        when %s and o.status <> 'ACCEPTED' then 'SENT'
-                        else o.status
-                      end,
-              sent_at = case
-                        when %s and o.status <> 'ACCEPTED' then coalesce(o.sent_at, now())
-                        else o.sent_at
-                      end
-            where o.id=%s and {_offer_owner_clause()} and o.archived=false
-            """,
-            (to_email, err_txt, ok, ok, offer_id, user_id, username_l),
+            "select record_email_result(%s, %s, %s, %s, %s)",
+            (offer_id, user_id, to_email, bool(ok), err_txt),
+            prepare=True,
         )
 
 
+_SELECT_OFFER_ROW_SQL = f"select * from offers o where o.id=%s and {_offer_owner_clause()}"
+_COPY_OFFER_META_SQL = f"""
+update offers o
+set
+  client_email=%s,
+  terms_delivery=%s,
+  terms_payment=%s,
+  note=%s,
+  place=%s,
+  signed_by=%s
+where o.id=%s and {_offer_owner_clause()}
+"""
+
+
 def duplicate_offer(user_id: int, username: str, offer_id: int) -> int:
     """Create a new DRAFT offer by copying meta + items from an existing offer."""
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        off = conn.execute(
-            f"""
-            select *
-            from offers o
-            where o.id=%s and {_offer_owner_clause()}
-            """,
-            (offer_id, user_id, username_l),
-        ).fetchone()
+        off = conn.execute(_SELECT_OFFER_ROW_SQL, (offer_id, user_id)).fetchone()
         if not off:
             raise ValueError("Offer not found")
 
         # New offer gets a fresh number for current year
-        new_id = create_offer(user_id, username_l, off.get("client_name"))
+        new_id = _create_offer(conn, user_id, username, off.get("client_name"))
         # copy fields (keep DRAFT)
         conn.execute(
-            f"""
-            update offers o
-            set
-              client_email=%s,
-              terms_delivery=%s,
-              terms_payment=%s,
-              note=%s,
-              place=%s,
-              signed_by=%s
-            where o.id=%s and {_offer_owner_clause()}
-            """,
+            _COPY_OFFER_META_SQL,
             (
                 off.get("client_email"),
                 off.get("terms_delivery"),
@@ -639,19 +860,20 @@ def duplicate_offer(user_id: int, username: str, offer_id: int) -> int:
                 off.get("signed_by"),
                 new_id,
                 user_id,
-                username_l,
             ),
         )
 
-        items = conn.execute(
-            "select name,qty,price,line_total from offer_items where offer_id=%s order by id asc",
-            (offer_id,),
-        ).fetchall()
-        for it in items:
-            conn.execute(
-                "insert into offer_items(offer_id,name,qty,price,line_total) values (%s,%s,%s,%s,%s)",
-                (new_id, it["name"], it["qty"], it["price"], it["line_total"]),
-            )
+        # Copy items server-side: rows never travel to Python and back (id order is kept)
+        conn.execute(
+            """
+            insert into offer_items(offer_id, name, qty, price, line_total)
+            select %s, name, qty, price, line_total
+            from offer_items
+            where offer_id=%s
+            order by id asc
+            """,
+            (new_id, offer_id),
+        )
         return int(new_id)
 
 
@@ -662,100 +884,98 @@ def import_user_backup(user_id: int, username: str, payload: dict, restore_as_ar
     items_map = payload.get("items") or {}
     imported = 0
     with get_conn() as conn:
+        # Every offer runs in its own savepoint, so a bad row only rolls back that offer.
+        # (No outer pipeline: _insert_items may COPY, which pipeline mode does not allow.)
         for o in offers:
             try:
-                # create offer preserving number if present (no uniqueness constraint)
-                row = conn.execute(
-                    """
-                    insert into offers(
-                      user_id, user_name,
-                      client_name, client_email,
-                      created_at, sent_at,
-                      offer_year, offer_seq, offer_no,
-                      status, accepted_at,
-                      archived, archived_at,
-                      terms_delivery, terms_payment, note, place, signed_by,
-                      vat_rate
+                with conn.transaction():
+                    # create offer preserving number if present (no uniqueness constraint)
+                    row = conn.execute(
+                        """
+                        insert into offers(
+                          user_id, user_name,
+                          client_name, client_email,
+                          created_at, sent_at,
+                          offer_year, offer_seq, offer_no,
+                          status, accepted_at,
+                          archived, archived_at,
+                          terms_delivery, terms_payment, note, place, signed_by,
+                          vat_rate
+                        )
+                        values (
+                          %s,%s,
+                          %s,%s,
+                          coalesce(%s::timestamptz, now()),
+                          %s::timestamptz,
+                          %s,%s,%s,
+                          %s,
+                          %s::timestamptz,
+                          %s,
+                          %s::timestamptz,
+                          %s,%s,%s,%s,%s,
+                          %s
+                        )
+                        returning id
+                        """,
+                        (
+                            user_id, username_l,
+                            o.get("client_name"), o.get("client_email"),
+                            o.get("created_at"), o.get("sent_at"),
+                            o.get("offer_year"), o.get("offer_seq"), o.get("offer_no"),
+                            (o.get("status") or "DRAFT"),
+                            o.get("accepted_at"),
+                            bool(o.get("archived")) if not restore_as_archived else True,
+                            o.get("archived_at"),
+                            o.get("terms_delivery"), o.get("terms_payment"), o.get("note"), o.get("place"), o.get("signed_by"),
+                            float(o.get("vat_rate") or 0),
+                        ),
+                    ).fetchone()
+                    new_oid = int(row["id"])
+                    src_oid = str(o.get("id") or "")
+                    src_items = (items_map.get(src_oid) or items_map.get(int(src_oid)) or []) if src_oid.isdigit() else []
+                    _insert_items(
+                        conn,
+                        [
+                            (new_oid, it.get("name"), float(it.get("qty") or 1), float(it.get("price") or 0), float(it.get("line_total") or 0))
+                            for it in src_items
+                        ],
                     )
-                    values (
-                      %s,%s,
-                      %s,%s,
-                      coalesce(%s::timestamptz, now()),
-                      %s::timestamptz,
-                      %s,%s,%s,
-                      %s,
-                      %s::timestamptz,
-                      %s,
-                      %s::timestamptz,
-                      %s,%s,%s,%s,%s,
-                      %s
-                    )
-                    returning id
-                    """,
-                    (
-                        user_id, username_l,
-                        o.get("client_name"), o.get("client_email"),
-                        o.get("created_at"), o.get("sent_at"),
-                        o.get("offer_year"), o.get("offer_seq"), o.get("offer_no"),
-                        (o.get("status") or "DRAFT"),
-                        o.get("accepted_at"),
-                        bool(o.get("archived")) if not restore_as_archived else True,
-                        o.get("archived_at"),
-                        o.get("terms_delivery"), o.get("terms_payment"), o.get("note"), o.get("place"), o.get("signed_by"),
-                        float(o.get("vat_rate") or 0),
-                    ),
-                ).fetchone()
-                new_oid = int(row["id"])
-                src_oid = str(o.get("id") or "")
-                src_items = items_map.get(src_oid) or items_map.get(int(src_oid)) if src_oid.isdigit() else []
-                for it in src_items:
-                    conn.execute(
-                        "insert into offer_items(offer_id,name,qty,price,line_total) values (%s,%s,%s,%s,%s)",
-                        (new_oid, it.get("name"), float(it.get("qty") or 1), float(it.get("price") or 0), float(it.get("line_total") or 0)),
-                    )
-                imported += 1
+                    imported += 1
             except Exception:
                 # keep going on a single bad row
                 continue
     return {"imported": imported}
 
 
+_ARCHIVE_OFFER_SQL = f"""
+update offers o
+set archived=true, archived_at=now()
+where o.id=%s and {_offer_owner_clause()} and archived=false
+"""
+_UNARCHIVE_OFFER_SQL = f"""
+update offers o
+set archived=false, archived_at=null
+where o.id=%s and {_offer_owner_clause()} and archived=true
+"""
+_OFFER_ARCHIVED_SQL = f"select o.archived from offers o where o.id=%s and {_offer_owner_clause()}"
+
+
 def archive_offer(user_id: int, username: str, offer_id: int) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        conn.execute(
-            f"""
-            update offers o
-            set archived=true, archived_at=now()
-            where o.id=%s and {_offer_owner_clause()} and archived=false
-            """,
-            (offer_id, user_id, username_l),
-        )
+        conn.execute(_ARCHIVE_OFFER_SQL, (offer_id, user_id), prepare=True)
 
 
 def unarchive_offer(user_id: int, username: str, offer_id: int) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        conn.execute(
-            f"""
-            update offers o
-            set archived=false, archived_at=null
-            where o.id=%s and {_offer_owner_clause()} and archived=true
-            """,
-            (offer_id, user_id, username_l),
-        )
+        conn.execute(_UNARCHIVE_OFFER_SQL, (offer_id, user_id), prepare=True)
 
 
 def delete_offer_permanently(user_id: int, username: str, offer_id: int) -> None:
     """
     Hard delete allowed only if archived=true (safety).
     """
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        row = conn.execute(
-            f"select o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
-        ).fetchone()
+        row = conn.execute(_OFFER_ARCHIVED_SQL, (offer_id, user_id), prepare=True).fetchone()
         if not row or not bool(row.get("archived")):
             return
         conn.execute("delete from offers where id=%s", (offer_id,))
@@ -765,76 +985,183 @@ def delete_offer_permanently(user_id: int, username: str, offer_id: int) -> None
 # Items
 # -----------------------------
 
+_INSERT_ITEM_SQL = f"""
+insert into offer_items(offer_id, name, qty, price, line_total)
+select o.id, %s, %s, %s, %s
+from offers o
+where {_OFFER_WRITE_GUARD}
+"""
+
+_DELETE_ITEM_SQL = f"""
+delete from offer_items i
+using offers o
+where i.id=%s and i.offer_id=o.id
+  and {_OFFER_WRITE_GUARD}
+"""
+
+_CLEAR_ITEMS_SQL = f"""
+delete from offer_items i
+using offers o
+where i.offer_id=o.id
+  and {_OFFER_WRITE_GUARD}
+"""
+
+
 def add_item(user_id: int, username: str, offer_id: int, name: str, qty: float, price: float) -> None:
-    username_l = (username or "").strip().lower()
     q = float(qty or 0)
     p = float(price or 0)
     line_total = q * p
+    with get_conn() as conn:
+        cur = conn.execute(
+            _INSERT_ITEM_SQL,
+            ((name or "").strip(), q, p, line_total, offer_id, user_id),
+            prepare=True,
+        )
+        if cur.rowcount == 0:
+            _raise_if_locked(conn, offer_id, user_id)
+
+
+# Above this many rows COPY beats executemany (one data stream, no per-row Bind/Execute).
+_COPY_ITEMS_MIN_ROWS = 100
+
+
+def _insert_items(conn, rows: list[tuple]) -> None:
+    """Bulk insert (offer_id, name, qty, price, line_total) rows on an open connection."""
+    if not rows:
+        return
+    if len(rows) > _COPY_ITEMS_MIN_ROWS:
+        with conn.cursor() as cur:
+            with cur.copy("copy offer_items(offer_id, name, qty, price, line_total) from stdin") as cp:
+                for r in rows:
+                    cp.write_row(r)
+        return
+    # Small batches: all Bind/Execute messages go out in one pipelined flush
+    with conn.pipeline(), conn.cursor() as cur:
+        cur.executemany(
+            "insert into offer_items(offer_id, name, qty, price, line_total) values (%s, %s, %s, %s, %s)",
+            rows,
+        )
+
+
+def add_items(user_id: int, username: str, offer_id: int, items: list[tuple]) -> None:
+    """Add many (name, qty, price) lines with one ownership check and one batched insert."""
+    rows = []
+    for name, qty, price in items:
+        q = float(qty or 0)
+        p = float(price or 0)
+        rows.append((offer_id, (name or "").strip(), q, p, q * p))
+    if not rows:
+        return
     with get_conn() as conn:
         offer = conn.execute(
-            f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
+            _OFFER_LOCK_STATE_SQL,
+            (offer_id, user_id),
+            prepare=True,
         ).fetchone()
         if not offer:
             return
         _ensure_editable(dict(offer))
-        conn.execute(
-            """
-            insert into offer_items(offer_id, name, qty, price, line_total)
-            values (%s, %s, %s, %s, %s)
-            """,
-            (offer_id, (name or "").strip(), q, p, line_total),
-        )
+        _insert_items(conn, rows)
 
 
 def list_items(offer_id: int):
-    with get_conn() as conn:
-        return conn.execute(
+    # Binary result format: floats/ints arrive in native form, no text parsing per cell.
+    with get_conn() as conn, conn.cursor(binary=True) as cur:
+        return cur.execute(
             """
-            select id, name, qty, price, line_total
+            select id, name, qty, price, line_total,
+                   sum(line_total) over () as offer_subtotal
             from offer_items
             where offer_id=%s
             order by id asc
             """,
             (offer_id,),
+            prepare=True,
         ).fetchall()
 
 
+def list_items_iter(offer_id: int) -> Iterator[Dict[str, Any]]:
+    """Yield offer items from a server-side cursor (batches of 500) instead of loading them all."""
+    with get_conn() as conn:
+        with conn.cursor(name="offer_items_cur", binary=True) as cur:
+            cur.itersize = 500
+            cur.execute(
+                """
+                select id, name, qty, price, line_total,
+                       sum(line_total) over () as offer_subtotal
+                from offer_items
+                where offer_id=%s
+                order by id asc
+                """,
+                (offer_id,),
+            )
+            yield from cur
+
+
 def delete_item(user_id: int, username: str, offer_id: int, item_id: int) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        offer = conn.execute(
-            f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
-        ).fetchone()
-        if not offer:
-            return
-        _ensure_editable(dict(offer))
-        conn.execute("delete from offer_items where offer_id=%s and id=%s", (offer_id, item_id))
+        cur = conn.execute(
+            _DELETE_ITEM_SQL,
+            (item_id, offer_id, user_id),
+            prepare=True,
+        )
+        if cur.rowcount == 0:
+            _raise_if_locked(conn, offer_id, user_id)
 
 
 def clear_items(user_id: int, username: str, offer_id: int) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        offer = conn.execute(
-            f"select o.status, o.archived from offers o where o.id=%s and {_offer_owner_clause()}",
-            (offer_id, user_id, username_l),
-        ).fetchone()
-        if not offer:
-            return
-        _ensure_editable(dict(offer))
-        conn.execute("delete from offer_items where offer_id=%s", (offer_id,))
+        cur = conn.execute(
+            _CLEAR_ITEMS_SQL,
+            (offer_id, user_id),
+            prepare=True,
+        )
+        if cur.rowcount == 0:
+            _raise_if_locked(conn, offer_id, user_id)
 
 
 # -----------------------------
 # Lists
 # -----------------------------
 
-def list_offers(user_id: int, username: str, status: str | None = None, client_id: int | None = None, **kwargs) -> list[dict]:
+@lru_cache(maxsize=None)
+def _list_offers_sql(show: str, by_status: bool, by_client: bool, by_q: bool, keyset: bool = False, limited: bool = False) -> str:
+    """One fixed SQL string per filter combination, so each variant keeps a stable prepared statement."""
+    where = []
+    # show filter (archived is NOT NULL; plain equality lets the partial indexes match)
+    if show == "active":
+        where.append("archived = false")
+    elif show == "archived":
+        where.append("archived = true")
+    # else "all" -> no archived filter
+    if by_status:
+        where.append("status=%s")
+    if by_client:
+        where.append("client_name = (select c.name from clients c where c.id=%s)")
+    if by_q:
+        where.append("(offer_no ilike %s or client_name ilike %s)")
+    if keyset:
+        # Row comparison in sort order: the (created_at desc, id desc) indexes resume right after the cursor
+        where.append("(created_at, id) < (%s, %s)")
+    sql = "select * from offers where " + (" and ".join(where) or "true") + " order by created_at desc, id desc"
+    return sql + " limit %s" if limited else sql
+
+
+def list_offers(
+    user_id: int,
+    username: str,
+    status: str | None = None,
+    client_id: int | None = None,
+    limit: int | None = None,
+    before: tuple[datetime, int] | None = None,
+    **kwargs,
+) -> list[dict]:
     """List offers for the admin UI.
 
     This app is admin-only, and older versions wrote offers with various owner fields (user_id/user_name may be null).
     To avoid hiding existing data, we default to showing ALL offers, then apply optional filters.
+
+    Paging (keyset): `limit` caps the rows; pass the last row's (created_at, id) as `before` for the next page.
     """
     # Backward-compatible params (older main.py used show/invoice/paid/client/q)
     show = (kwargs.get("show") or "").strip().lower()  # active|archived|all|""
@@ -850,49 +1177,45 @@ def list_offers(user_id: int, username: str, status: str | None = None, client_i
     if status and str(status).strip().upper() == "ALL":
         status = None
 
-    where = ["1=1"]
     params: list = []
-
-    # show filter (column archived exists in our schema; coalesce handles nulls)
-    if show in ("active", ""):
-        where.append("(archived is false or archived is null)")
-    elif show in ("archived",):
-        where.append("archived is true")
-    # else "all" -> no archived filter
-
     if status:
-        where.append("status=%s")
         params.append(status)
-
     if client_id is not None:
-        where.append("client_id=%s")
+        # offers carry the client name, not an id
         params.append(client_id)
-
     if q:
-        where.append("(offer_no ilike %s or client_name ilike %s)")
         like = f"%{q}%"
         params.extend([like, like])
-
-    sql = "select * from offers where " + " and ".join(where) + " order by created_at desc"
-    with get_conn() as conn:
-        rows = conn.execute(sql, tuple(params)).fetchall()
-    return [dict(r) for r in rows]
+    if before is not None:
+        params.extend(before)
+    if limit is not None:
+        params.append(int(limit))
+
+    sql = _list_offers_sql(
+        "active" if show in ("active", "") else ("archived" if show == "archived" else "all"),
+        bool(status),
+        client_id is not None,
+        bool(q),
+        before is not None,
+        limit is not None,
+    )
+    with get_conn() as conn, conn.cursor(binary=True) as cur:
+        # dict_row rows are already plain dicts: hand them over without a copy
+        return cur.execute(sql, tuple(params), prepare=True).fetchall()
 
 
 def list_clients_full(user_id: int, username: str) -> List[Dict[str, Any]]:
     """Return full client records for a user."""
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        rows = conn.execute(
+        return conn.execute(
             """
             select id, name, email, address, oib, note
             from clients
-            where (user_id=%s or (user_id is null and lower(user_name)=%s))
+            where user_id=%s
             order by name asc
             """,
-            (user_id, username_l),
+            (user_id,),
         ).fetchall()
-        return [dict(r) for r in rows]
 
 
 def list_clients(user_id: int, username: str):
@@ -901,22 +1224,20 @@ def list_clients(user_id: int, username: str):
 
 
 def get_client_by_name(user_id: int, username: str, name: str) -> Optional[Dict[str, Any]]:
-    username_l = (username or "").strip().lower()
     nm = (name or "").strip()
     if not nm:
         return None
     with get_conn() as conn:
-        row = conn.execute(
+        return conn.execute(
             """
             select id, name, email, address, oib, note
             from clients
-            where (user_id=%s or (user_id is null and lower(user_name)=%s))
+            where user_id=%s
               and name=%s
             limit 1
             """,
-            (user_id, username_l, nm),
+            (user_id, nm),
         ).fetchone()
-        return dict(row) if row else None
 
 
 def upsert_client_full(
@@ -934,10 +1255,10 @@ def upsert_client_full(
     if not nm:
         return
 
-    em = (email or "").strip() or None
-    addr = (address or "").strip() or None
-    o = (oib or "").strip() or None
-    nt = (note or "").strip() or None
+    em = _strip_or_none(email)
+    addr = _strip_or_none(address)
+    o = _strip_or_none(oib)
+    nt = _strip_or_none(note)
 
     with get_conn() as conn:
         conn.execute(
@@ -960,54 +1281,104 @@ def upsert_client(user_id: int, username: str, name: str) -> None:
     """Compatibility wrapper."""
     upsert_client_full(user_id, username, name)
 
+_DASHBOARD_MONTHLY_SQL = f"""
+select
+  m.month,
+  coalesce(x.offers_count, 0)::int as offers_count,
+  coalesce(x.subtotal, 0)::double precision as subtotal
+from generate_series(1, 12) as m(month)
+left join (
+  -- offers.total is the trigger-maintained items sum, so no join/distinct is needed
+  select
+    extract(month from o.created_at)::int as month,
+    count(*) as offers_count,
+    sum(o.total) as subtotal
+  from offers o
+  where ({_offer_owner_clause()})
+    and extract(year from o.created_at)=%s
+    and o.archived=false
+  group by 1
+) x on x.month = m.month
+order by m.month asc
+"""
+
+
 def dashboard_monthly(user_id: int, username: str, year: int | None = None):
-    """Return monthly counts and totals (subtotal) for a given year."""
-    username_l = (username or "").strip().lower()
+    """Return monthly counts and totals (subtotal) for a given year, one row per month (1..12)."""
     yr = int(year or datetime.now().year)
-    with get_conn() as conn:
-        rows = conn.execute(
-            f"""
-            select
-              extract(month from o.created_at)::int as month,
-              count(distinct o.id)::int as offers_count,
-              coalesce(sum(i.line_total),0)::double precision as subtotal
-            from offers o
-            left join offer_items i on i.offer_id=o.id
-            where ({_offer_owner_clause()})
-              and extract(year from o.created_at)=%s
-              and o.archived=false
-            group by extract(month from o.created_at)
-            order by month asc
-            """,
-            (user_id, username_l, yr),
+    with get_conn() as conn, conn.cursor(binary=True) as cur:
+        return cur.execute(
+            _DASHBOARD_MONTHLY_SQL,
+            (user_id, yr),
+            prepare=True,
         ).fetchall()
-        # fill missing months
-        bym = {int(r["month"]): {"month": int(r["month"]), "offers_count": int(r["offers_count"]), "subtotal": float(r["subtotal"])} for r in rows}
-        out=[]
-        for m in range(1,13):
-            out.append(bym.get(m, {"month": m, "offers_count": 0, "subtotal": 0.0}))
-        return out
 
 
 # -----------------------------
 # Settings
 # -----------------------------
 
-def get_settings(user_id: int, username: str) -> dict:
+_SETTINGS_TTL = 60.0
+_SETTINGS_CACHE_MAX = 256
+# (fetched_at, settings, logo_bytes): one company_settings read serves settings, templates and logo
+_SETTINGS_CACHE: OrderedDict[tuple[int, str], tuple[float, dict, bytes | None]] = OrderedDict()
+_SETTINGS_LOCK = threading.Lock()
+
+
+def _invalidate_settings(user_id: int, username: str) -> None:
+    with _SETTINGS_LOCK:
+        _SETTINGS_CACHE.pop((int(user_id), (username or "").strip().lower()), None)
+
+
+def get_settings_bundle(user_id: int, username: str) -> tuple[dict, Dict[str, str], bytes | None]:
+    """(settings, templates, logo_bytes) for the user from one query; cached in-process for _SETTINGS_TTL seconds.
+
+    settings is a copy; templates has the defaults filled in (see get_templates).
+    """
     username_l = (username or "").strip().lower()
+    key = (int(user_id), username_l)
+    now = time.monotonic()
+    with _SETTINGS_LOCK:
+        hit = _SETTINGS_CACHE.get(key)
+        if hit and now - hit[0] < _SETTINGS_TTL:
+            _SETTINGS_CACHE.move_to_end(key)
+            return dict(hit[1]), _templates_from(hit[1]), hit[2]
     with get_conn() as conn:
-        row = conn.execute(
-            """
-            select user_name, user_id, company_name, company_address, company_oib, company_iban,
-                   company_email, company_phone, logo_path,
-                   (logo_bytes is not null) as has_logo,
-                   logo_mime, logo_filename
-            from company_settings
-            where (user_id=%s or (user_id is null and lower(user_name)=%s))
-            """,
-            (user_id, username_l),
+        data, logo_bytes = _fetch_settings_with_logo(conn, user_id)
+    with _SETTINGS_LOCK:
+        _SETTINGS_CACHE[key] = (now, data, logo_bytes)
+        _SETTINGS_CACHE.move_to_end(key)
+        while len(_SETTINGS_CACHE) > _SETTINGS_CACHE_MAX:
+            _SETTINGS_CACHE.popitem(last=False)
+    return dict(data), _templates_from(data), logo_bytes
+
+
+def get_settings(user_id: int, username: str) -> dict:
+    """Company settings for the user (a copy; see get_settings_bundle for caching)."""
+    return get_settings_bundle(user_id, username)[0]
+
+
+_SETTINGS_COLUMNS = """
+    user_name, user_id, company_name, company_address, company_oib, company_iban,
+    company_email, company_phone, logo_path,
+    (logo_bytes is not null) as has_logo,
+    logo_mime, logo_filename,
+    email_subject_tpl, email_html_tpl, email_text_tpl, pdf_footer_tpl
+"""
+_FETCH_SETTINGS_WITH_LOGO_SQL = f"select {_SETTINGS_COLUMNS}, logo_bytes from company_settings where user_id=%s"
+
+
+def _fetch_settings_with_logo(conn, user_id: int) -> tuple[dict, bytes | None]:
+    """Settings (as get_settings) plus the raw logo in one round-trip on the caller's connection."""
+    with conn.cursor(binary=True) as cur:
+        row = cur.execute(
+            _FETCH_SETTINGS_WITH_LOGO_SQL,
+            (user_id,),
+            prepare=True,
         ).fetchone()
-        return dict(row) if row else {}
+    if not row:
+        return {}, None
+    return row, (row.pop("logo_bytes") or None)
 
 
 def upsert_settings(
@@ -1062,39 +1433,25 @@ def upsert_settings(
                 logo_filename,
             ),
         )
+    _invalidate_settings(user_id, username)
 
 
 def clear_logo(user_id: int, username: str) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
         conn.execute(
             """
             update company_settings
             set logo_bytes=null, logo_mime=null, logo_filename=null
-            where (user_id=%s or (user_id is null and lower(user_name)=%s))
+            where user_id=%s
             """,
-            (user_id, username_l),
+            (user_id,),
         )
+    _invalidate_settings(user_id, username)
 
 
 def get_logo_bytes(user_id: int, username: str) -> tuple[bytes | None, str | None]:
-    username_l = (username or "").strip().lower()
-    with get_conn() as conn:
-        row = conn.execute(
-            """
-            select logo_bytes, logo_mime
-            from company_settings
-            where (user_id=%s or (user_id is null and lower(user_name)=%s))
-            """,
-            (user_id, username_l),
-        ).fetchone()
-        if not row:
-            return None, None
-        b = row.get("logo_bytes")
-        # psycopg returns memoryview for bytea
-        if b is not None and isinstance(b, memoryview):
-            b = b.tobytes()
-        return (b if b else None), (row.get("logo_mime") if row.get("logo_mime") else None)
+    settings, _tpls, logo_bytes = get_settings_bundle(user_id, username)
+    return logo_bytes, (settings.get("logo_mime") or None)
 
 
 
@@ -1115,11 +1472,10 @@ def log_audit(user_id: int | None, username: str | None, action: str, offer_id:
 
 def list_audit(limit: int = 200) -> List[Dict[str, Any]]:
     with get_conn() as conn:
-        rows = conn.execute(
+        return conn.execute(
             "select id, created_at, username, action, offer_id, ip, meta from audit_log order by id desc limit %s",
             (int(limit),),
         ).fetchall()
-        return [dict(r) for r in rows]
 
 
 # -----------------------------
@@ -1131,8 +1487,7 @@ DEFAULT_EMAIL_TEXT = "Poštovani,\n\nU prilogu je ponuda {offer_no}.\n\nLijep po
 DEFAULT_EMAIL_HTML = "<p>Poštovani,</p><p>U prilogu je ponuda <b>{offer_no}</b>.</p><p>Lijep pozdrav,<br>{company_name}</p>"
 DEFAULT_PDF_FOOTER = ""
 
-def get_templates(user_id: int, username: str) -> Dict[str, str]:
-    s = get_settings(user_id, username) or {}
+def _templates_from(s: dict) -> Dict[str, str]:
     return {
         "email_subject_tpl": s.get("email_subject_tpl") or DEFAULT_EMAIL_SUBJECT,
         "email_text_tpl": s.get("email_text_tpl") or DEFAULT_EMAIL_TEXT,
@@ -1141,6 +1496,10 @@ def get_templates(user_id: int, username: str) -> Dict[str, str]:
     }
 
 
+def get_templates(user_id: int, username: str) -> Dict[str, str]:
+    return get_settings_bundle(user_id, username)[1]
+
+
 def set_templates(user_id: int, username: str, subject: str, text_t: str, html_t: str, footer: str) -> None:
     username_l = (username or "").strip().lower()
     with get_conn() as conn:
@@ -1158,12 +1517,20 @@ def set_templates(user_id: int, username: str, subject: str, text_t: str, html_t
             """,
             (username_l, user_id, subject, text_t, html_t, footer),
         )
+    _invalidate_settings(user_id, username)
 
 # -----------------------------
 # PDF / Excel exports
 # -----------------------------
 
+@lru_cache(maxsize=4)
 def _register_font(static_dir: str) -> str:
+    """Register DejaVuSans once per static dir (TTFont parses the whole .ttf)."""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    if "DejaVuSans" in pdfmetrics.getRegisteredFontNames():
+        return "DejaVuSans"
     font_path = Path(static_dir) / "DejaVuSans.ttf"
     if font_path.exists():
         try:
@@ -1174,15 +1541,30 @@ def _register_font(static_dir: str) -> str:
     return "Helvetica"
 
 
+@lru_cache(maxsize=16)
+def _logo_reader(logo_bytes: bytes) -> tuple[ImageReader, int, int] | None:
+    """Decode a logo once per distinct image (PDF batches reuse the same user logo)."""
+    from reportlab.lib.utils import ImageReader
+
+    try:
+        img = ImageReader(io.BytesIO(logo_bytes))
+        iw, ih = img.getSize()
+    except Exception:
+        return None
+    if not iw or not ih:
+        return None
+    return img, int(iw), int(ih)
+
+
 def _draw_logo(c: canvas.Canvas, logo_bytes: bytes, x: float, y: float, max_w: float, max_h: float) -> float:
     """
     Draw logo with aspect ratio. Returns used height.
     """
     try:
-        img = ImageReader(io.BytesIO(logo_bytes))
-        iw, ih = img.getSize()
-        if not iw or not ih:
+        decoded = _logo_reader(bytes(logo_bytes))
+        if decoded is None:
             return 0.0
+        img, iw, ih = decoded
         scale = min(max_w / float(iw), max_h / float(ih))
         w = float(iw) * scale
         h = float(ih) * scale
@@ -1215,19 +1597,64 @@ def _wrap_text(text: str, max_chars: int) -> list[str]:
     return lines
 
 
-def _draw_kv_block(c: canvas.Canvas, font: str, x: float, y: float, title: str, lines: list[str], width: float) -> float:
+class _FontState:
+    """The render's font on one canvas, as last set through use().
+
+    use() calls setFont only when the size changes (each call writes a Tf op to the page stream).
+    showPage() and restoreState() reset the canvas font: call reset() after either.
+    """
+
+    __slots__ = ("c", "name", "size")
+
+    def __init__(self, c: canvas.Canvas, name: str) -> None:
+        self.c = c
+        self.name = name
+        self.size: Optional[float] = None
+
+    def use(self, size: float) -> None:
+        if size != self.size:
+            self.c.setFont(self.name, size)
+            self.size = size
+
+    def reset(self) -> None:
+        self.size = None
+
+
+def _draw_kv_block(c: canvas.Canvas, fs: _FontState, x: float, y: float, title: str, lines: list[str], width: float) -> float:
     """Draw a simple titled block and return new y (below the block)."""
-    c.setFont(font, 10)
     c.rect(x, y - 6 - (14*len(lines)+18), width, 14*len(lines)+22, stroke=1, fill=0)
-    c.setFont(font, 11)
-    c.drawString(x + 8, y, title)
+    # Title + lines in one text object (drawString opens a BT/ET block per call).
+    # Sizes go on the text object: a canvas setFont here would land in the page stream before it.
+    to = c.beginText(x + 8, y)
+    to.setFont(fs.name, 11)
+    to.textOut(title)
+    to.setFont(fs.name, 10)
     yy = y - 18
-    c.setFont(font, 10)
     for ln in lines:
-        c.drawString(x + 8, yy, ln[:120])
+        to.setTextOrigin(x + 8, yy)
+        to.textOut(ln[:120])
         yy -= 14
+    c.drawText(to)
+    # The text object's Tf ops outlive it: the next use() must set the font again
+    fs.reset()
     return yy - 10
 
+
+def _draw_company_block(c: canvas.Canvas, fs: _FontState, settings: Dict[str, Any], x: float, y: float) -> None:
+    """Company name/address/ids under the document title, as one text object."""
+    lines = [str(settings[key]) for key in ("company_name", "company_address") if settings.get(key)]
+    for label, key in (("OIB", "company_oib"), ("IBAN", "company_iban"), ("E-mail", "company_email"), ("Tel", "company_phone")):
+        if settings.get(key):
+            lines.append(f"{label}: {settings.get(key)}")
+    if not lines:
+        return
+    fs.use(10)
+    to = c.beginText(x, y)
+    to.setLeading(14)
+    for ln in lines:
+        to.textLine(ln)
+    c.drawText(to)
+
 def _draw_footer(c: canvas.Canvas, font: str, footer_text: str, x: float, y: float, w: float) -> float:
     """Draw footer text (wrapped). Returns height used."""
     if not footer_text:
@@ -1253,63 +1680,146 @@ def _draw_footer(c: canvas.Canvas, font: str, footer_text: str, x: float, y: flo
 
 import secrets
 
+# Sets the token only while it is null (no row write once it exists) and returns the stored one.
+_ENSURE_PUBLIC_TOKEN_SQL = f"""
+with upd as (
+  update offers o set public_token=%s
+  where o.id=%s and {_offer_owner_clause()} and o.public_token is null
+  returning o.public_token
+)
+select public_token from upd
+union all
+select o.public_token from offers o
+where o.id=%s and {_offer_owner_clause()} and o.public_token is not null
+"""
+
+
 def ensure_public_token(user_id: int, username: str, offer_id: int) -> str:
     """Ensure offer has a stable public token for portal/tracking."""
     with get_conn() as conn:
         row = conn.execute(
-            "select public_token from offers where id=%s and (user_id=%s or user_name=%s)",
-            (offer_id, user_id, username),
+            _ENSURE_PUBLIC_TOKEN_SQL,
+            (secrets.token_urlsafe(18), offer_id, user_id, offer_id, user_id),
+            prepare=True,
         ).fetchone()
-        if row and row.get("public_token"):
-            return str(row["public_token"])
-        token = secrets.token_urlsafe(18)
-        conn.execute(
-            "update offers set public_token=%s where id=%s and (user_id=%s or user_name=%s)",
-            (token, offer_id, user_id, username),
-        )
-        return token
+        if row is None:
+            # Lost a race to a concurrent first call (its token is committed now) or no such offer.
+            row = conn.execute(
+                "select public_token from offers where id=%s and user_id=%s",
+                (offer_id, user_id),
+            ).fetchone()
+        if not row:
+            raise ValueError("Offer not found")
+        return str(row["public_token"])
 
 def get_offer_by_token(token: str) -> dict | None:
     with get_conn() as conn:
-        row = conn.execute("select * from offers where public_token=%s", (token,)).fetchone()
-        return dict(row) if row else None
+        return conn.execute("select * from offers where public_token=%s", (token,)).fetchone()
 
 def list_items_for_offer(offer_id: int) -> list[dict]:
     return list_items(offer_id)
 
-def mark_offer_sent(user_id: int, username: str, offer_id: int) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            "update offers set status='SENT', sent_at=now() where id=%s and (user_id=%s or user_name=%s) and status!='ACCEPTED'",
-            (offer_id, user_id, username),
-        )
+# Open/click tracking is telemetry: requests only enqueue the event and a daemon thread writes
+# batches (up to _TRACK_BATCH events or _TRACK_FLUSH_INTERVAL seconds), one UPDATE per kind.
+_TRACK_BATCH = 100
+_TRACK_FLUSH_INTERVAL = 0.5
+_TRACK_QUEUE: queue.Queue[tuple[str, str, str | None, datetime]] = queue.Queue(maxsize=10000)
+_TRACK_THREAD: threading.Thread | None = None
+_TRACK_LOCK = threading.Lock()
+
+# Per-token aggregates as parallel arrays: (token, n, first_at, last_at, last_ip)
+_TRACK_OPEN_SQL = """
+update offers o
+   set view_count = o.view_count + v.n,
+       first_view_at = coalesce(o.first_view_at, v.first_at),
+       last_view_at = greatest(o.last_view_at, v.last_at),
+       last_view_ip = v.ip
+  from unnest(%s::text[], %s::int[], %s::timestamptz[], %s::timestamptz[], %s::text[]) as v(token, n, first_at, last_at, ip)
+ where o.public_token = v.token
+"""
+_TRACK_CLICK_SQL = """
+update offers o
+   set click_count = o.click_count + v.n,
+       last_click_at = greatest(o.last_click_at, v.last_at),
+       last_click_ip = v.ip
+  from unnest(%s::text[], %s::int[], %s::timestamptz[], %s::timestamptz[], %s::text[]) as v(token, n, first_at, last_at, ip)
+ where o.public_token = v.token
+"""
+
+
+def _write_tracking(events: list[tuple[str, str, str | None, datetime]]) -> None:
+    """Coalesce events per (kind, token) and apply them; failures drop the batch (telemetry only)."""
+    try:
+        agg: Dict[tuple[str, str], list] = {}
+        for kind, token, ip, at in events:
+            a = agg.get((kind, token))
+            if a is None:
+                agg[(kind, token)] = [1, at, at, ip]
+            else:
+                a[0] += 1
+                a[2] = at
+                a[3] = ip
+        with get_conn() as conn:
+            for kind, sql in (("open", _TRACK_OPEN_SQL), ("click", _TRACK_CLICK_SQL)):
+                rows = [(token, *a) for (k, token), a in agg.items() if k == kind]
+                if rows:
+                    conn.execute(sql, [list(col) for col in zip(*rows)], prepare=True)
+    except Exception:
+        logger.exception("[tracking] dropped %d events", len(events))
+    finally:
+        for _ in events:
+            _TRACK_QUEUE.task_done()
+
+
+def _tracking_worker() -> None:
+    while True:
+        batch = [_TRACK_QUEUE.get()]
+        deadline = time.monotonic() + _TRACK_FLUSH_INTERVAL
+        while len(batch) < _TRACK_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_TRACK_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _write_tracking(batch)
+
+
+def _track(kind: str, token: str, ip: str | None) -> None:
+    global _TRACK_THREAD
+    if _TRACK_THREAD is None:
+        with _TRACK_LOCK:
+            if _TRACK_THREAD is None:
+                t = threading.Thread(target=_tracking_worker, name="offer-tracking", daemon=True)
+                t.start()
+                atexit.register(flush_tracking)
+                _TRACK_THREAD = t
+    try:
+        _TRACK_QUEUE.put_nowait((kind, token, ip, datetime.now(timezone.utc)))
+    except queue.Full:
+        pass
+
+
+def flush_tracking() -> None:
+    """Write all queued open/click events now (app shutdown, tests) and wait for in-flight batches."""
+    events = []
+    while True:
+        try:
+            events.append(_TRACK_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    if events:
+        _write_tracking(events)
+    _TRACK_QUEUE.join()
+
 
 def track_open(token: str, ip: str | None = None) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            """
-            update offers
-               set view_count = coalesce(view_count,0)+1,
-                   first_view_at = coalesce(first_view_at, now()),
-                   last_view_at = now(),
-                   last_view_ip = %s
-             where public_token = %s
-            """,
-            (ip, token),
-        )
+    _track("open", token, ip)
+
 
 def track_click(token: str, ip: str | None = None) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            """
-            update offers
-               set click_count = coalesce(click_count,0)+1,
-                   last_click_at = now(),
-                   last_click_ip = %s
-             where public_token = %s
-            """,
-            (ip, token),
-        )
+    _track("click", token, ip)
 
 def accept_by_token(token: str, ip: str | None = None) -> bool:
     with get_conn() as conn:
@@ -1326,15 +1836,29 @@ def accept_by_token(token: str, ip: str | None = None) -> bool:
         )
         return res.rowcount > 0
 
-def _draw_pdf_bg(c, static_dir: str) -> None:
-    """Full-page subtle PNG background for PDFs (optional)."""
+@lru_cache(maxsize=4)
+def _bg_reader(static_dir: str) -> tuple[ImageReader, int, int] | None:
+    """Open/decode pdf_bg.png once per static dir instead of once per rendered PDF."""
+    from reportlab.lib.utils import ImageReader
+
     bg_path = os.path.join(static_dir, "pdf_bg.png")
     if not os.path.exists(bg_path):
+        return None
+    img = ImageReader(bg_path)
+    iw, ih = img.getSize()
+    return img, iw, ih
+
+
+def _draw_pdf_bg(c, static_dir: str) -> None:
+    """Full-page subtle PNG background for PDFs (optional)."""
+    decoded = _bg_reader(static_dir)
+    if decoded is None:
         return
+    from reportlab.lib.pagesizes import A4
+
+    img, iw, ih = decoded
     w, h = A4
     c.saveState()
-    img = ImageReader(bg_path)
-    iw, ih = img.getSize()
     scale = max(w / iw, h / ih)
     dw, dh = iw * scale, ih * scale
     x = (w - dw) / 2
@@ -1344,12 +1868,18 @@ def _draw_pdf_bg(c, static_dir: str) -> None:
 
 def render_offer_pdf(
     offer: Dict[str, Any],
-    items: List[Dict[str, Any]],
+    items: Iterable[Dict[str, Any]],
     settings: Dict[str, Any],
     static_dir: str,
     logo_bytes: bytes | None = None,
-) -> bytes:
-    buf = io.BytesIO()
+    out: BinaryIO | None = None,
+) -> bytes | None:
+    """Render the offer PDF. With `out`, reportlab writes straight into that stream and None is returned."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfgen import canvas
+
+    buf = out if out is not None else io.BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
     w, h = A4
 
@@ -1357,6 +1887,7 @@ def render_offer_pdf(
     _draw_pdf_bg(c, static_dir)
 
     font = _register_font(static_dir)
+    fs = _FontState(c, font)
 
     top_y = h - 40
     logo_h = 0.0
@@ -1373,52 +1904,20 @@ def render_offer_pdf(
                 c.setFillAlpha(0.08)
             except Exception:
                 pass
-            c.setFont(font, 72)
+            fs.use(72)
             c.translate(w/2, h/2)
             c.rotate(30)
             c.drawCentredString(0, 0, wm)
             c.restoreState()
+            fs.reset()
     except Exception:
         pass
 
-    c.setFont(font, 16)
+    fs.use(16)
     c.drawString(40 + (160 if logo_h else 0), h - 50, "Ponuda")
 
-    c.setFont(font, 10)
-    y_company = h - 70
-    x_company = 40 + (160 if logo_h else 0)
-    if settings.get("company_name"):
-        c.drawString(x_company, y_company, str(settings.get("company_name")))
-        y_company -= 14
-    if settings.get("company_address"):
-        c.drawString(x_company, y_company, str(settings.get("company_address")))
-        y_company -= 14
-
-    if settings.get("company_oib"):
-        c.drawString(x_company, y_company, f"OIB: {settings.get('company_oib')}")
-        y_company -= 14
-    if settings.get("company_iban"):
-        c.drawString(x_company, y_company, f"IBAN: {settings.get('company_iban')}")
-        y_company -= 14
-    if settings.get("company_email"):
-        c.drawString(x_company, y_company, f"E-mail: {settings.get('company_email')}")
-        y_company -= 14
-    if settings.get("company_phone"):
-        c.drawString(x_company, y_company, f"Tel: {settings.get('company_phone')}")
-        y_company -= 14
-
-    if settings.get("company_oib"):
-        c.drawString(x_company, y_company, f"OIB: {settings.get('company_oib')}")
-        y_company -= 14
-    if settings.get("company_iban"):
-        c.drawString(x_company, y_company, f"IBAN: {settings.get('company_iban')}")
-        y_company -= 14
-    if settings.get("company_email"):
-        c.drawString(x_company, y_company, f"E-mail: {settings.get('company_email')}")
-        y_company -= 14
-    if settings.get("company_phone"):
-        c.drawString(x_company, y_company, f"Tel: {settings.get('company_phone')}")
-        y_company -= 14
+    fs.use(10)
+    _draw_company_block(c, fs, settings, x=40 + (160 if logo_h else 0), y=h - 70)
 
     c.drawRightString(w - 40, h - 70, f"Broj: {offer.get('offer_no') or ''}")
     c.drawRightString(w - 40, h - 85, f"Datum: {str(offer.get('created_at') or '')[:16]}")
@@ -1440,58 +1939,82 @@ def render_offer_pdf(
     if offer.get("client_email"):
         client_lines.append(f"E-mail: {offer.get('client_email')}")
 
-    y_after_client = _draw_kv_block(c, font, x=40, y=h - 132, title="Kupac", lines=client_lines or [""], width=w - 80)
+    y_after_client = _draw_kv_block(c, fs, x=40, y=h - 132, title="Kupac", lines=client_lines or [""], width=w - 80)
 
 
 
-    # Table header
+    # Table header (right-aligned column x positions shared with the item rows)
+    x_qty, x_price, x_total = w - 220, w - 140, w - 40
     y = y_after_client
-    c.setFont(font, 10)
+    fs.use(10)
     c.drawString(40, y, "Naziv")
-    c.drawRightString(w - 220, y, "Količina")
-    c.drawRightString(w - 140, y, "Cijena")
-    c.drawRightString(w - 40, y, "Ukupno")
+    c.drawRightString(x_qty, y, "Količina")
+    c.drawRightString(x_price, y, "Cijena")
+    c.drawRightString(x_total, y, "Ukupno")
     y -= 10
     c.line(40, y, w - 40, y)
     y -= 16
 
-    subtotal = Decimal("0")
+    # Lines are drawn from the stored line_total; list_items()/list_items_iter() also
+    # ship the SQL sum(line_total) so the subtotal needs no per-row Decimal work.
+    sql_subtotal = None
+    lines_sum = 0.0
+    # One text object (single BT/ET block) per page for the whole table; numbers are
+    # right-aligned by offsetting each with its measured width.
+    text_width = pdfmetrics.stringWidth
+    to = c.beginText()
+    to.setFont(font, 10)
     for it in items:
         name = str(it.get("name") or "")
-        qty = Decimal(str(it.get("qty", 0) or 0))
-        price = Decimal(str(it.get("price", 0) or 0))
-        line_total = qty * price
-        subtotal += line_total
-
-        c.drawString(40, y, name[:60])
-        c.drawRightString(w - 220, y, f"{qty:.2f}")
-        c.drawRightString(w - 140, y, f"{price:.2f}")
-        c.drawRightString(w - 40, y, f"{line_total:.2f}")
+        qty = float(it.get("qty", 0) or 0)
+        price = float(it.get("price", 0) or 0)
+        line_total = float(it.get("line_total") or 0)
+        if sql_subtotal is None:
+            sql_subtotal = it.get("offer_subtotal")
+        lines_sum += line_total
+
+        qty_s = f"{qty:.2f}"
+        price_s = f"{price:.2f}"
+        total_s = f"{line_total:.2f}"
+        to.setTextOrigin(40, y)
+        to.textOut(name[:60])
+        to.setTextOrigin(x_qty - text_width(qty_s, font, 10), y)
+        to.textOut(qty_s)
+        to.setTextOrigin(x_price - text_width(price_s, font, 10), y)
+        to.textOut(price_s)
+        to.setTextOrigin(x_total - text_width(total_s, font, 10), y)
+        to.textOut(total_s)
         y -= 14
         if y < 90:
+            c.drawText(to)
             c.showPage()
-            c.setFont(font, 10)
+            fs.reset()
+            fs.use(10)
+            to = c.beginText()
+            to.setFont(font, 10)
             y = h - 60
+    c.drawText(to)
 
-    vat_rate = Decimal(str(offer.get("vat_rate", 0) or 0))
-    vat = (subtotal * vat_rate / Decimal("100")) if vat_rate else Decimal("0")
-    total = subtotal + vat
+    subtotal = float(sql_subtotal if sql_subtotal is not None else lines_sum)
+    vat_rate = float(offer.get("vat_rate", 0) or 0)
+    vat = round(subtotal * vat_rate / 100.0 + 1e-9, 2) if vat_rate else 0.0
+    total = round(subtotal + vat + 1e-9, 2)
 
     y -= 8
     c.line(40, y, w - 40, y)
     y -= 18
     c.drawRightString(w - 40, y, f"Međuzbroj: {subtotal:.2f} €")
     y -= 14
-    if vat_rate and vat_rate != Decimal("0"):
+    if vat_rate:
         c.drawRightString(w - 40, y, f"PDV {vat_rate:.0f}%: {vat:.2f} €")
         y -= 16
     else:
         y -= 2
-    c.setFont(font, 12)
+    fs.use(12)
     c.drawRightString(w - 40, y, f"Ukupno: {total:.2f} €")
 
     # Meta lines
-    c.setFont(font, 10)
+    fs.use(10)
     y -= 28
     for label, key in [
         ("Mjesto", "place"),
@@ -1505,23 +2028,26 @@ def render_offer_pdf(
             c.drawString(40, y, f"{label}: {val}")
             y -= 14
 
-    c.showPage()
-    
-    # Footer (template)
+    # Footer (template), on the last page
     footer_tpl = (settings.get("pdf_footer_tpl") or "").strip()
     if footer_tpl:
         _draw_footer(c, font, footer_tpl, x=40, y=28, w=w-80)
+    c.showPage()
     c.save()
-    return buf.getvalue()
+    return None if out is not None else buf.getvalue()
 
 
 def render_invoice_pdf(
     offer: Dict[str, Any],
-    items: List[Dict[str, Any]],
+    items: Iterable[Dict[str, Any]],
     settings: Dict[str, Any],
     static_dir: str,
     logo_bytes: bytes | None = None,
 ) -> bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfgen import canvas
+
     buf = io.BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
     w, h = A4
@@ -1530,50 +2056,18 @@ def render_invoice_pdf(
     _draw_pdf_bg(c, static_dir)
 
     font = _register_font(static_dir)
+    fs = _FontState(c, font)
 
     top_y = h - 40
     logo_h = 0.0
     if logo_bytes:
         logo_h = _draw_logo(c, logo_bytes, x=40, y=top_y, max_w=140, max_h=60)
 
-    c.setFont(font, 16)
+    fs.use(16)
     c.drawString(40 + (160 if logo_h else 0), h - 50, "Račun")
 
-    c.setFont(font, 10)
-    y_company = h - 70
-    x_company = 40 + (160 if logo_h else 0)
-    if settings.get("company_name"):
-        c.drawString(x_company, y_company, str(settings.get("company_name")))
-        y_company -= 14
-    if settings.get("company_address"):
-        c.drawString(x_company, y_company, str(settings.get("company_address")))
-        y_company -= 14
-
-    if settings.get("company_oib"):
-        c.drawString(x_company, y_company, f"OIB: {settings.get('company_oib')}")
-        y_company -= 14
-    if settings.get("company_iban"):
-        c.drawString(x_company, y_company, f"IBAN: {settings.get('company_iban')}")
-        y_company -= 14
-    if settings.get("company_email"):
-        c.drawString(x_company, y_company, f"E-mail: {settings.get('company_email')}")
-        y_company -= 14
-    if settings.get("company_phone"):
-        c.drawString(x_company, y_company, f"Tel: {settings.get('company_phone')}")
-        y_company -= 14
-
-    if settings.get("company_oib"):
-        c.drawString(x_company, y_company, f"OIB: {settings.get('company_oib')}")
-        y_company -= 14
-    if settings.get("company_iban"):
-        c.drawString(x_company, y_company, f"IBAN: {settings.get('company_iban')}")
-        y_company -= 14
-    if settings.get("company_email"):
-        c.drawString(x_company, y_company, f"E-mail: {settings.get('company_email')}")
-        y_company -= 14
-    if settings.get("company_phone"):
-        c.drawString(x_company, y_company, f"Tel: {settings.get('company_phone')}")
-        y_company -= 14
+    fs.use(10)
+    _draw_company_block(c, fs, settings, x=40 + (160 if logo_h else 0), y=h - 70)
 
     c.drawRightString(w - 40, h - 70, f"Račun broj: {offer.get('invoice_no') or ''}")
     inv_date = offer.get("invoice_date") or offer.get("accepted_at") or offer.get("created_at") or ""
@@ -1593,14 +2087,14 @@ def render_invoice_pdf(
     if offer.get("client_email"):
         client_lines.append(f"E-mail: {offer.get('client_email')}")
 
-    y_after_client = _draw_kv_block(c, font, x=40, y=h - 142, title="Kupac", lines=client_lines or [""], width=w - 80)
+    y_after_client = _draw_kv_block(c, fs, x=40, y=h - 142, title="Kupac", lines=client_lines or [""], width=w - 80)
 
 
     if offer.get("client_email"):
         c.drawString(40, h - 145, f"E-mail: {offer.get('client_email') or ''}")
 
     y = y_after_client
-    c.setFont(font, 10)
+    fs.use(10)
     c.drawString(40, y, "Naziv")
     c.drawRightString(w - 220, y, "Količina")
     c.drawRightString(w - 140, y, "Cijena")
@@ -1609,60 +2103,76 @@ def render_invoice_pdf(
     c.line(40, y, w - 40, y)
     y -= 16
 
-    subtotal = Decimal("0")
+    # Same single-text-object table as render_offer_pdf (one BT/ET block per page)
+    text_width = pdfmetrics.stringWidth
+    to = c.beginText()
+    to.setFont(font, 10)
+    subtotal = 0.0
     for it in items:
         name = str(it.get("name") or "")
-        qty = Decimal(str(it.get("qty", 0) or 0))
-        price = Decimal(str(it.get("price", 0) or 0))
+        qty = float(it.get("qty", 0) or 0)
+        price = float(it.get("price", 0) or 0)
         line_total = qty * price
         subtotal += line_total
 
-        c.drawString(40, y, name[:60])
-        c.drawRightString(w - 220, y, f"{qty:.2f}")
-        c.drawRightString(w - 140, y, f"{price:.2f}")
-        c.drawRightString(w - 40, y, f"{line_total:.2f}")
+        qty_s = f"{qty:.2f}"
+        price_s = f"{price:.2f}"
+        total_s = f"{line_total:.2f}"
+        to.setTextOrigin(40, y)
+        to.textOut(name[:60])
+        to.setTextOrigin(w - 220 - text_width(qty_s, font, 10), y)
+        to.textOut(qty_s)
+        to.setTextOrigin(w - 140 - text_width(price_s, font, 10), y)
+        to.textOut(price_s)
+        to.setTextOrigin(w - 40 - text_width(total_s, font, 10), y)
+        to.textOut(total_s)
         y -= 14
         if y < 110:
+            c.drawText(to)
             c.showPage()
-            c.setFont(font, 10)
+            fs.reset()
+            fs.use(10)
+            to = c.beginText()
+            to.setFont(font, 10)
             y = h - 60
+    c.drawText(to)
 
-    vat_rate = Decimal("25")
-    vat = subtotal * vat_rate / Decimal("100")
-    total = subtotal + vat
+    # Display-only amounts: round like render_offer_pdf (the epsilon keeps x.xx5 ties rounding up)
+    vat_rate = 25.0
+    vat = round(subtotal * vat_rate / 100.0 + 1e-9, 2)
+    total = round(subtotal + vat + 1e-9, 2)
 
     y -= 8
     c.line(40, y, w - 40, y)
     y -= 18
     c.drawRightString(w - 40, y, f"Međuzbroj: {subtotal:.2f} €")
     y -= 14
-    if vat_rate and vat_rate != Decimal("0"):
+    if vat_rate:
         c.drawRightString(w - 40, y, f"PDV {vat_rate:.0f}%: {vat:.2f} €")
         y -= 16
     else:
         y -= 2
-    c.setFont(font, 12)
+    fs.use(12)
     c.drawRightString(w - 40, y, f"Ukupno: {total:.2f} €")
 
-    footer = (settings.get("pdf_footer_tpl") or "").strip()
-    if footer:
-        c.setFont(font, 9)
-        c.drawString(40, 40, footer[:140])
-
-    c.showPage()
-    
-    # Footer (template)
+    # Footer (template), on the last page
     footer_tpl = (settings.get("pdf_footer_tpl") or "").strip()
     if footer_tpl:
         _draw_footer(c, font, footer_tpl, x=40, y=28, w=w-80)
+    c.showPage()
     c.save()
     return buf.getvalue()
 
 
-def render_offer_excel(offer: Dict[str, Any], items: List[Dict[str, Any]]) -> bytes:
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Ponuda"
+def render_offer_excel(offer: Dict[str, Any], items: Iterable[Dict[str, Any]]) -> bytes:
+    import openpyxl
+    from openpyxl.utils import get_column_letter
+
+    # write_only streams rows straight to the sheet XML; widths must be set before the first append
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Ponuda")
+    for col in range(1, 5):
+        ws.column_dimensions[get_column_letter(col)].width = 22
 
     ws.append(["Naziv", "Količina", "Cijena", "Ukupno"])
     for it in items:
@@ -1670,66 +2180,221 @@ def render_offer_excel(offer: Dict[str, Any], items: List[Dict[str, Any]]) -> by
         price = float(it.get("price", 0) or 0)
         ws.append([it.get("name", ""), qty, price, qty * price])
 
-    for col in range(1, 5):
-        ws.column_dimensions[get_column_letter(col)].width = 22
-
     buf = io.BytesIO()
     wb.save(buf)
     return buf.getvalue()
 
 
 
-def export_user_backup_zip(user_id: int, username: str, static_dir: str) -> bytes:
-    """Create a ZIP: offers.json + PDFs for all non-archived offers of the user."""
+# Exports render serially unless at least this many PDFs need rendering (cache misses).
+# A spawned worker costs ~0.4s to start and warm up vs a few ms per warm in-process render,
+# so with 4 workers the pool only breaks even somewhere past ~100 PDFs.
+_EXPORT_PARALLEL_MIN = 100
+_EXPORT_WORKER_CTX: Dict[str, Any] = {}
+
+
+def _init_export_worker(settings: Dict[str, Any], static_dir: str, logo_bytes: Optional[bytes]) -> None:
+    # Shared render inputs are shipped once per worker instead of once per offer.
+    _EXPORT_WORKER_CTX.update(settings=settings, static_dir=static_dir, logo_bytes=logo_bytes)
+
+
+def _render_export_pdf(job) -> bytes:
+    offer, items = job
+    return render_offer_pdf(offer=offer, items=items, **_EXPORT_WORKER_CTX)
+
+
+@contextmanager
+def _export_renderer(n_fresh: int, settings: Dict[str, Any], static_dir: str, logo_bytes: Optional[bytes]):
+    """Yield render(jobs) -> PDFs in job order; one renderer serves every batch of an export."""
+    workers = min(os.cpu_count() or 1, n_fresh)
+    if n_fresh < _EXPORT_PARALLEL_MIN or workers < 2:
+        def render(jobs: List[tuple]) -> Iterator[bytes]:
+            for offer, items in jobs:
+                yield render_offer_pdf(offer=offer, items=items, settings=settings, static_dir=static_dir, logo_bytes=logo_bytes)
+        yield render
+        return
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    # spawn: the parent holds pool/worker threads, which fork() would copy mid-state
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_export_worker,
+        initargs=(settings, static_dir, logo_bytes),
+    ) as ex:
+        yield lambda jobs: ex.map(_render_export_pdf, jobs)
+
+
+# Rendered export PDFs keyed by a hash of everything render_offer_pdf reads; LRU bounded by total size.
+_PDF_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_PDF_CACHE: OrderedDict[str, bytes] = OrderedDict()
+_PDF_CACHE_SIZE = 0
+_PDF_CACHE_LOCK = threading.Lock()
+
+
+def _pdf_cache_get(key: str) -> Optional[bytes]:
+    with _PDF_CACHE_LOCK:
+        pdf = _PDF_CACHE.get(key)
+        if pdf is not None:
+            _PDF_CACHE.move_to_end(key)
+        return pdf
+
+
+def _pdf_cache_put(key: str, pdf: bytes) -> None:
+    global _PDF_CACHE_SIZE
+    if len(pdf) > _PDF_CACHE_MAX_BYTES // 4:
+        return
+    with _PDF_CACHE_LOCK:
+        old = _PDF_CACHE.pop(key, None)
+        if old is not None:
+            _PDF_CACHE_SIZE -= len(old)
+        _PDF_CACHE[key] = pdf
+        _PDF_CACHE_SIZE += len(pdf)
+        while _PDF_CACHE_SIZE > _PDF_CACHE_MAX_BYTES:
+            _, evicted = _PDF_CACHE.popitem(last=False)
+            _PDF_CACHE_SIZE -= len(evicted)
+
+
+def _export_ctx_key(settings: Dict[str, Any], static_dir: str, logo_bytes: Optional[bytes]) -> bytes:
+    # Settings/logo/static dir are shared by every offer: hash them once and use the digest as the blake2b key.
+    ctx = hashlib.blake2b(orjson.dumps([settings, static_dir]), digest_size=16)
+    ctx.update(logo_bytes or b"")
+    return ctx.digest()
+
+
+def _export_pdf_key(ctx_key: bytes, offer: Dict[str, Any], items: List[Dict[str, Any]]) -> str:
+    return hashlib.blake2b(orjson.dumps([offer, items]), digest_size=16, key=ctx_key).hexdigest()
+
+
+def _export_pdfs(jobs: List[tuple], keys: List[str], render) -> Iterator[bytes]:
+    """PDFs for jobs in order: cached ones by content key, the rest through render() (see _export_renderer)."""
+    cached = [_pdf_cache_get(k) for k in keys]
+    fresh = iter(render([job for job, pdf in zip(jobs, cached) if pdf is None]))
+    for key, pdf in zip(keys, cached):
+        if pdf is None:
+            pdf = next(fresh)
+            _pdf_cache_put(key, pdf)
+        yield pdf
+
+
+_EXPORT_BATCH = 100
+# Only what offers.json/import_user_backup and render_offer_pdf consume
+# (no tracking counters/IPs, public tokens or email diagnostics).
+_EXPORT_OFFERS_SQL = f"""
+select o.id, o.offer_no, o.offer_year, o.offer_seq, o.created_at, o.sent_at,
+       o.status, o.accepted_at, o.archived, o.archived_at,
+       o.client_name, o.client_email, o.client_address, o.client_oib,
+       o.terms_delivery, o.terms_payment, o.note, o.place, o.signed_by,
+       o.vat_rate, o.valid_until, o.total,
+       o.invoice_no, o.invoice_date, o.paid, o.paid_at
+from offers o
+where ({_offer_owner_clause()})
+order by o.created_at desc, o.id desc
+"""
+# One row per offer: its items arrive as a single json array instead of one tuple each.
+_EXPORT_ITEMS_SQL = """
+select offer_id,
+       json_agg(json_build_object('id', id, 'name', name, 'qty', qty, 'price', price, 'line_total', line_total)
+                order by id) as items
+from offer_items
+where offer_id = any(%s::bigint[])
+group by offer_id
+"""
+# items fragments of offers.json stay in memory up to this size, then spill to a temp file
+_EXPORT_SPOOL_MAX = 8 * 1024 * 1024
+# Characters that are path separators or invalid in Windows file names -> "-" in zip entry names
+_OFFER_NO_TRANS = str.maketrans({c: "-" for c in '/\\:*?"<>|'})
+
+
+def _iter_export_batches(conn, user_id: int) -> Iterator[List[tuple]]:
+    """(offer, items) pairs in export order, one list per server-side cursor batch.
+
+    Each batch pulls its items in one round-trip, aggregated per offer; dict_row rows are kept as-is.
+    """
+    with conn.cursor(name="export_offers_cur") as cur:
+        cur.execute(_EXPORT_OFFERS_SQL, (user_id,))
+        while True:
+            batch = cur.fetchmany(_EXPORT_BATCH)
+            if not batch:
+                break
+            ids = [int(o["id"]) for o in batch]
+            items_map = {row["offer_id"]: row["items"] for row in conn.execute(_EXPORT_ITEMS_SQL, (ids,), prepare=True)}
+            yield [(o, items_map.get(oid, [])) for o, oid in zip(batch, ids)]
+
+
+def export_user_backup_zip(user_id: int, username: str, static_dir: str, out: BinaryIO | None = None) -> bytes | None:
+    """Create a ZIP: offers.json + PDFs for all offers of the user, archived ones included.
+    With `out` (seekable), the archive is written straight into that stream and None is returned."""
+    import shutil
+    import tempfile
     import zipfile
+    exported_at = datetime.now(timezone.utc)
     username_l = (username or "").strip().lower()
-    with get_conn() as conn:
-        offers = conn.execute(
-            f"""
-            select o.*
-            from offers o
-            where ({_offer_owner_clause()})
-            order by o.created_at desc, o.id desc
-            """,
-            (user_id, username_l),
-        ).fetchall()
-
-        # collect items per offer
-        offers_out = []
-        items_map = {}
-        for o in offers:
-            oid = int(o["id"])
-            items = conn.execute(
-                "select id,name,qty,price,line_total from offer_items where offer_id=%s order by id asc",
-                (oid,),
-            ).fetchall()
-            items_map[oid] = [dict(it) for it in items]
-            offers_out.append(dict(o))
-
-    # Build zip
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as z:
-        z.writestr("offers.json", json.dumps({"user": username_l, "exported_at": datetime.now().isoformat(), "offers": offers_out, "items": items_map}, ensure_ascii=False, indent=2))
-        # PDFs
-        settings = get_settings(user_id, username_l)
-        logo_bytes, _ = get_logo_bytes(user_id, username_l)
-        for o in offers_out:
-            oid = int(o["id"])
-            pdf = render_offer_pdf(offer=o, items=items_map.get(oid, []), settings=settings, static_dir=static_dir, logo_bytes=logo_bytes)
-            offer_no = (o.get("offer_no") or str(oid)).replace("/", "-")
-            z.writestr(f"pdf/ponuda_{offer_no}.pdf", pdf)
-    return buf.getvalue()
+    # Every entry carries the export time (explicit ZipInfo, no per-entry localtime()).
+    # Zip timestamps are local wall-clock time by convention.
+    entry_date = exported_at.astimezone().timetuple()[:6]
+    buf = out if out is not None else io.BytesIO()
+    settings: Dict[str, Any] = {}
+    logo_bytes: Optional[bytes] = None
+    keys: List[str] = []
+    n_fresh = 0
+    with get_conn() as conn, zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as z:
+        # Two passes over the offers (JSON, then PDFs) read one snapshot, so both describe the same data.
+        conn.execute("set transaction isolation level repeatable read, read only", prepare=False)
+
+        # offers.json: offers go into the entry batch by batch; their items (a separate object after
+        # the offers array) are spooled meanwhile. orjson serialises datetime/date natively.
+        zi = zipfile.ZipInfo("offers.json", date_time=entry_date)
+        zi.compress_type = zipfile.ZIP_DEFLATED
+        with z.open(zi, "w") as fp, tempfile.SpooledTemporaryFile(_EXPORT_SPOOL_MAX) as items_fp:
+            fp.write(b'{"user":%s,"exported_at":%s,"offers":[' % (orjson.dumps(username_l), orjson.dumps(exported_at)))
+            for batch in _iter_export_batches(conn, user_id):
+                # Nothing to render for an empty export: settings/logo are only read once there is an offer.
+                if not keys:
+                    settings, logo_bytes = _fetch_settings_with_logo(conn, user_id)
+                    ctx_key = _export_ctx_key(settings, static_dir, logo_bytes)
+                for o, its in batch:
+                    if keys:
+                        fp.write(b",")
+                        items_fp.write(b",")
+                    fp.write(orjson.dumps(o))
+                    items_fp.write(b'"%d":%s' % (o["id"], orjson.dumps(its)))
+                    key = _export_pdf_key(ctx_key, o, its)
+                    keys.append(key)
+                    n_fresh += _pdf_cache_get(key) is None
+            fp.write(b'],"items":{')
+            items_fp.seek(0)
+            shutil.copyfileobj(items_fp, fp)
+            fp.write(b"}}")
+
+        # PDFs, rendered batch by batch; the zip itself is only written from this thread.
+        # PDF streams are already Flate-compressed; re-deflating them costs CPU for ~0% gain.
+        if keys:
+            with _export_renderer(n_fresh, settings, static_dir, logo_bytes) as render:
+                n = 0
+                for batch in _iter_export_batches(conn, user_id):
+                    for (o, _its), pdf in zip(batch, _export_pdfs(batch, keys[n:n + len(batch)], render)):
+                        offer_no = (o.get("offer_no") or str(o["id"])).translate(_OFFER_NO_TRANS)
+                        zi = zipfile.ZipInfo(f"pdf/ponuda_{offer_no}.pdf", date_time=entry_date)
+                        zi.compress_type = zipfile.ZIP_STORED
+                        z.writestr(zi, pdf)
+                    n += len(batch)
+    return None if out is not None else buf.getvalue()
 # -----------------------------
 # Invoices (stored on offers rows)
 # -----------------------------
 
+_SET_INVOICE_PAID_SQL = f"""
+update offers o
+set paid=%s,
+    paid_at=case when %s then now() else null end
+where o.id=%s and {_offer_owner_clause()} and o.invoice_no is not null
+"""
+
+
 def create_invoice_from_offer(user_id: int, username: str, offer_id: int) -> Dict[str, Any]:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        row = conn.execute(
-            f"select * from offers o where ({_offer_owner_clause()}) and o.id=%s",
-            (user_id, username_l, offer_id),
-        ).fetchone()
+        row = conn.execute(_SELECT_OFFER_ROW_SQL, (offer_id, user_id)).fetchone()
         if not row:
             raise ValueError("Offer not found")
         offer = dict(row)
@@ -1744,10 +2409,10 @@ def create_invoice_from_offer(user_id: int, username: str, offer_id: int) -> Dic
             """
             select coalesce(max(invoice_seq), 0) as max_seq
             from offers
-            where (user_id=%s or (user_id is null and lower(user_name)=%s))
+            where user_id=%s
               and invoice_year=%s
             """,
-            (user_id, username_l, year),
+            (user_id, year),
         ).fetchone()
         next_seq = int((row_seq or {}).get("max_seq") or 0) + 1
         invoice_no = f"{year}-{next_seq:04d}"
@@ -1769,16 +2434,7 @@ def create_invoice_from_offer(user_id: int, username: str, offer_id: int) -> Dic
 
 
 def set_invoice_paid(user_id: int, username: str, offer_id: int, paid: bool) -> None:
-    username_l = (username or "").strip().lower()
     with get_conn() as conn:
-        conn.execute(
-            f"""
-            update offers o
-            set paid=%s,
-                paid_at=case when %s then now() else null end
-            where ({_offer_owner_clause()}) and o.id=%s and o.invoice_no is not null
-            """,
-            (bool(paid), bool(paid), user_id, username_l, offer_id),
-        )
+        conn.execute(_SET_INVOICE_PAID_SQL, (bool(paid), bool(paid), offer_id, user_id), prepare=True)
 
 
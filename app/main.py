@@ -5,6 +5,7 @@ import html
 import smtplib
 import json
 import base64
+import tempfile
 import urllib.request
 import urllib.error
 from email.message import EmailMessage
@@ -15,7 +16,7 @@ from typing import Any, Dict, Tuple
 
 from fastapi import FastAPI, File, Form, Request, UploadFile
 from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, Response
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
@@ -60,37 +61,19 @@ def _static_logo_png() -> Response:
 
 @app.on_event("startup")
 def _startup() -> None:
+    db.open_pool()
     db.init_db()
 
 
+@app.on_event("shutdown")
+def _shutdown() -> None:
+    db.flush_tracking()
+    db.close_pool()
 
 
-import logging
 
-def draw_pdf_background(c, static_dir: str) -> None:
-    """Draw a subtle full-page PNG background (watermark) for offer PDFs."""
-    bg_path = os.path.join(static_dir, "pdf_bg.png")
-    if not os.path.exists(bg_path):
-        return
-
-    page_w, page_h = A4
-    c.saveState()
-    # If reportlab supports alpha, keep it subtle
-    try:
-        c.setFillAlpha(0.10)
-    except Exception:
-        pass
-
-    img = ImageReader(bg_path)
-    iw, ih = img.getSize()
-    scale = max(page_w / iw, page_h / ih)
-    w = iw * scale
-    h = ih * scale
-    x = (page_w - w) / 2
-    y = (page_h - h) / 2
-    c.drawImage(img, x, y, width=w, height=h, mask="auto")
-    c.restoreState()
 
+import logging
 
 logger = logging.getLogger("ponude")
 if not logger.handlers:
@@ -176,6 +159,56 @@ def _ensure_offer(request: Request, username: str, user_id: int) -> int:
     return int(new_id)
 
 
+def _ensure_offer_row(request: Request, username: str, user_id: int) -> dict:
+    """Like _ensure_offer, but hand back the fetched offer row so routes don't load it twice."""
+    oid = _get_offer_id(request)
+    if oid is not None:
+        off = db.get_offer(user_id, username, oid)
+        if off:
+            return dict(off)
+    new_id = db.create_offer(user_id, username, None)
+    request.session["offer_id"] = int(new_id)
+    return dict(db.get_offer(user_id, username, int(new_id)) or {"id": int(new_id)})
+
+
+PDF_SPOOL_MAX = 1024 * 1024  # keep small PDFs in RAM, spill bigger ones to a temp file
+BACKUP_SPOOL_MAX = 8 * 1024 * 1024
+
+
+def _spooled_response(
+    write,
+    fname: str,
+    media_type: str = "application/pdf",
+    disposition: str = "attachment",
+    max_size: int = PDF_SPOOL_MAX,
+) -> StreamingResponse:
+    """Render via write(stream) into a spooled temp file and stream it back in chunks."""
+    spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+    try:
+        write(spool)
+        size = spool.tell()
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+
+    def _chunks():
+        try:
+            while True:
+                chunk = spool.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            spool.close()
+
+    return StreamingResponse(
+        _chunks(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'{disposition}; filename="{fname}"', "Content-Length": str(size)},
+    )
+
+
 
 
 @app.get("/catalog")
@@ -220,8 +253,8 @@ def logout_post(request: Request):
 @app.get("/offer", response_class=HTMLResponse)
 def offer_page(request: Request):
     username, user_id = _user_ctx(request)
-    offer_id = _ensure_offer(request, username, user_id)
-    offer = dict(db.get_offer(user_id, username, offer_id) or {})
+    offer = _ensure_offer_row(request, username, user_id)
+    offer_id = int(offer["id"])
     if offer.get("vat_rate") is None:
         offer["vat_rate"] = 0
     items = db.list_items(offer_id)
@@ -237,7 +270,7 @@ def offer_page(request: Request):
         token = None
         portal_url = None
 
-    subtotal = sum(float(it.get("line_total") or 0) for it in items)
+    subtotal = float(items[0]["offer_subtotal"]) if items else 0.0
     vat_rate = float(offer.get('vat_rate') or 0)
     vat = subtotal * (vat_rate / 100.0) if vat_rate else 0.0
     total = subtotal + vat
@@ -302,7 +335,10 @@ def offers_pdf(request: Request, offer_id: int):
 def offers_portal(request: Request, offer_id: int):
     username = require_admin(request).strip().lower()
     user_id = db.ensure_user(username)
-    token = db.ensure_public_token(user_id, username, int(offer_id))
+    try:
+        token = db.ensure_public_token(user_id, username, int(offer_id))
+    except ValueError:
+        return RedirectResponse(url="/offers?err=Ponuda+ne+postoji", status_code=HTTP_303_SEE_OTHER)
     return RedirectResponse(url=f"/p/{token}", status_code=HTTP_303_SEE_OTHER)
 
 
@@ -318,14 +354,10 @@ def offer_client(
     username, user_id = _user_ctx(request)
     offer_id = _ensure_offer(request, username, user_id)
     try:
-        db.update_offer_client_details(user_id, username, offer_id, (client_name or "").strip() or None, client_email, client_address, client_oib)
+        # Offer client fields + client list upsert, one statement
+        db.save_offer_client(user_id, username, offer_id, client_name, client_email, client_address, client_oib)
     except Exception as e:
         return RedirectResponse(url=f"/offer?err={str(e).replace(' ', '+')}", status_code=HTTP_303_SEE_OTHER)
-    # Keep a lightweight client list
-    try:
-        db.upsert_client_full(user_id, username, (client_name or "").strip(), email=client_email, address=client_address, oib=client_oib)
-    except Exception:
-        pass
     return RedirectResponse(url="/offer?ok=Spremljen+klijent", status_code=HTTP_303_SEE_OTHER)
 
 
@@ -383,17 +415,18 @@ def offer_meta(
     username, user_id = _user_ctx(request)
     offer_id = _ensure_offer(request, username, user_id)
     try:
-        db.update_offer_client_email(user_id, username, offer_id, (client_email or "").strip() or None)
-        db.update_offer_meta(
+        db.save_offer_meta(
             user_id=user_id,
             username=username,
             offer_id=offer_id,
+            client_email=client_email,
             terms_delivery=(terms_delivery or "").strip() or None,
             terms_payment=(terms_payment or "").strip() or None,
             note=(note or "").strip() or None,
             place=(place or "").strip() or None,
             signed_by=(signed_by or "").strip() or None,
             vat_rate=float(vat_rate or 0),
+            valid_until=valid_until,
         )
     except Exception as e:
         return RedirectResponse(url=f"/offer?err={str(e).replace(' ', '+')}", status_code=HTTP_303_SEE_OTHER)
@@ -455,34 +488,28 @@ def offer_duplicate(request: Request, offer_id: int = Form(...)):
 @app.get("/offer/pdf")
 def offer_pdf(request: Request):
     username, user_id = _user_ctx(request)
-    offer_id = _ensure_offer(request, username, user_id)
-
-    offer = dict(db.get_offer(user_id, username, offer_id) or {})
+    offer = _ensure_offer_row(request, username, user_id)
+    offer_id = int(offer["id"])
     if offer.get("vat_rate") is None:
         offer["vat_rate"] = 0
-    items = db.list_items(offer_id)
-    settings = db.get_settings(user_id, username)
-    logo_bytes, _mime = db.get_logo_bytes(user_id, username)
+    items = db.list_items_iter(offer_id)
+    settings, _tpls, logo_bytes = db.get_settings_bundle(user_id, username)
 
-    pdf_bytes = db.render_offer_pdf(offer=offer, items=items, settings=settings, static_dir=str(STATIC_DIR), logo_bytes=logo_bytes)
     fname = f"ponuda_{username}_{offer.get('offer_no') or offer_id}.pdf"
-
-    return Response(
-        content=pdf_bytes,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f'attachment; filename="{fname}"'},
+    return _spooled_response(
+        lambda out: db.render_offer_pdf(offer=offer, items=items, settings=settings, static_dir=str(STATIC_DIR), logo_bytes=logo_bytes, out=out),
+        fname,
     )
 
 
 @app.get("/offer/excel")
 def offer_excel(request: Request):
     username, user_id = _user_ctx(request)
-    offer_id = _ensure_offer(request, username, user_id)
-
-    offer = dict(db.get_offer(user_id, username, offer_id) or {})
+    offer = _ensure_offer_row(request, username, user_id)
+    offer_id = int(offer["id"])
     if offer.get("vat_rate") is None:
         offer["vat_rate"] = 0
-    items = db.list_items(offer_id)
+    items = db.list_items_iter(offer_id)
 
     xls_bytes = db.render_offer_excel(offer=offer, items=items)
     fname = f"ponuda_{username}_{offer.get('offer_no') or offer_id}.xlsx"
@@ -528,7 +555,7 @@ def portal_page(token: str, request: Request):
     offer_id = int(off["id"])
     items = db.list_items(offer_id)
     # Render minimal portal view (no auth)
-    subtotal = sum(float(it.get("line_total") or 0) for it in items)
+    subtotal = float(items[0]["offer_subtotal"]) if items else 0.0
     vat_rate = float(off.get("vat_rate") or 0)
     vat = subtotal * (vat_rate / 100.0) if vat_rate else 0.0
     total = subtotal + vat
@@ -617,15 +644,17 @@ def portal_pdf(token: str, request: Request):
     if not off:
         return HTMLResponse("Not found", status_code=404)
     offer_id = int(off["id"])
-    items = db.list_items(offer_id)
+    items = db.list_items_iter(offer_id)
     # settings for rendering: use stored per-user settings when possible
     username = (off.get("user_name") or "user").strip().lower()
     user_id = int(off.get("user_id") or db.ensure_user(username))
-    settings = db.get_settings(user_id, username)
-    logo_bytes, _mime = db.get_logo_bytes(user_id, username)
-    pdf_bytes = db.render_offer_pdf(offer=dict(off), items=items, settings=settings, static_dir=str(STATIC_DIR), logo_bytes=logo_bytes)
+    settings, _tpls, logo_bytes = db.get_settings_bundle(user_id, username)
     fname = f"ponuda_{off.get('offer_no') or offer_id}.pdf"
-    return Response(content=pdf_bytes, media_type="application/pdf", headers={"Content-Disposition": f'inline; filename="{fname}"'})
+    return _spooled_response(
+        lambda out: db.render_offer_pdf(offer=dict(off), items=items, settings=settings, static_dir=str(STATIC_DIR), logo_bytes=logo_bytes, out=out),
+        fname,
+        disposition="inline",
+    )
 
 
 def _send_brevo(api_key: str, from_email: str, from_name: str, to_email: str, subject: str, html_body: str, text_body: str = "", attachment_pdf: bytes | None = None, attachment_name: str = "ponuda.pdf") -> None:
@@ -673,12 +702,10 @@ def offer_send(
     body: str = Form(""),
 ):
     username, user_id = _user_ctx(request)
-    offer_id = _ensure_offer(request, username, user_id)
-
-    offer = dict(db.get_offer(user_id, username, offer_id) or {})
-    items = db.list_items(offer_id)
-    settings = db.get_settings(user_id, username)
-    logo_bytes, _mime = db.get_logo_bytes(user_id, username)
+    offer = _ensure_offer_row(request, username, user_id)
+    offer_id = int(offer["id"])
+    items = db.list_items_iter(offer_id)
+    settings, tpls, logo_bytes = db.get_settings_bundle(user_id, username)
 
     recipient = (to_email or "").strip() or (offer.get("client_email") or "").strip()
     if not recipient:
@@ -708,7 +735,6 @@ def offer_send(
     offer_no = offer.get("offer_no") or str(offer_id)
     client_name = (offer.get("client_name") or "").strip() or "klijent"
 
-    tpls = db.get_templates(user_id, username)
     ctx = {
     "offer_no": offer_no,
     "client_name": client_name,
@@ -989,10 +1015,10 @@ def dashboard_page(request: Request):
 @app.get("/settings", response_class=HTMLResponse)
 def settings_page(request: Request):
     username, user_id = _user_ctx(request)
-    settings = db.get_settings(user_id, username)
+    settings, tpls, _logo = db.get_settings_bundle(user_id, username)
     return templates.TemplateResponse(
         "settings.html",
-        {"request": request, "user": username, "settings": settings, "templates": db.get_templates(user_id, username), "ok": request.query_params.get("ok")},
+        {"request": request, "user": username, "settings": settings, "templates": tpls, "ok": request.query_params.get("ok")},
     )
 
 
@@ -1189,14 +1215,15 @@ async def backup_import(
 @app.get("/backup/export")
 def backup_export(request: Request):
     username, user_id = _user_ctx(request)
-    data = db.export_user_backup_zip(user_id, username, static_dir=str(STATIC_DIR))
-    db.log_audit(user_id, username, "backup_export", ip=_client_ip(request))
     fname = f"ponude_backup_{username}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-    return Response(
-        content=data,
+    resp = _spooled_response(
+        lambda out: db.export_user_backup_zip(user_id, username, static_dir=str(STATIC_DIR), out=out),
+        fname,
         media_type="application/zip",
-        headers={"Content-Disposition": f'attachment; filename="{fname}"'},
+        max_size=BACKUP_SPOOL_MAX,
     )
+    db.log_audit(user_id, username, "backup_export", ip=_client_ip(request))
+    return resp
 
 
 @app.get("/__routes")
@@ -1232,9 +1259,8 @@ def invoice_pdf(request: Request):
     offer = dict(db.get_offer(user_id, username, int(offer_id)) or {})
     if not offer.get("invoice_no"):
         return RedirectResponse(url="/offer?err=Nema+računa+za+ovu+ponudu", status_code=HTTP_303_SEE_OTHER)
-    items = db.list_items(int(offer_id))
-    settings = db.get_settings(user_id, username)
-    logo_bytes, _mime = db.get_logo_bytes(user_id, username)
+    items = db.list_items_iter(int(offer_id))
+    settings, _tpls, logo_bytes = db.get_settings_bundle(user_id, username)
     pdf = db.render_invoice_pdf(offer=offer, items=items, settings=settings, static_dir=str(STATIC_DIR), logo_bytes=logo_bytes)
     db.log_audit(user_id, username, "invoice_pdf", offer_id=int(offer_id), ip=_client_ip(request))
     return Response(content=pdf, media_type="application/pdf", headers={"Content-Disposition": f"attachment; filename=Racun_{offer.get('invoice_no')}.pdf"})
@@ -1274,7 +1300,7 @@ def admin_users(request: Request):
     # reuse dashboard template in a minimal way (no extra template files)
     with db.get_conn() as conn:
         users = conn.execute("select id, username, created_at from users order by id asc").fetchall()
-    return templates.TemplateResponse("dashboard.html", {"request": request, "user": admin, "admin_view": "users", "users": [dict(u) for u in users]})
+    return templates.TemplateResponse("dashboard.html", {"request": request, "user": admin, "admin_view": "users", "users": users})
 
 
 @app.post("/admin/users/create")